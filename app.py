@@ -4,16 +4,43 @@ import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import math
+import gzip
+import hashlib
+import io
+import secrets
+import zipfile
 from prs_core import (
-    calculate_prs, 
     generate_realistic_genotypes,
     generate_realistic_genotype,
     get_genotype_options, 
     SNP_DATA, 
-    get_risk_interpretation
+    SNP_IDS,
+    get_risk_interpretation,
+    get_percentile_band,
+    calculate_percentile_interval,
+    bootstrap_reference_distribution,
+    genotype_to_dosage,
+    genotypes_to_dosages,
+    dosages_to_genotypes,
+    encode_dosage_token,
+    decode_dosage_token,
+    PRS_MODELS,
+    DEFAULT_MODEL_ID,
+    calculate_model_scores,
+    calculate_model_percentiles,
+    get_model_info,
+    get_aligned_model_weights,
+    get_snp_model,
+    get_chromosome_snp_groups,
+    get_reference_pdf_grid,
+    shared_asset,
+    warm_shared_assets,
+    count_effect_snps_batch
 )
 
-from circos_visualization import display_circos_in_streamlit, check_pycircos_availability
+from circos_visualization import display_circos_in_streamlit, check_pycircos_availability, prerender_circos_states
+from genotype_io import iter_cohort_table_chunks, read_consumer_bytes
+from cohort_scoring import start_background_preview
 
 THEME_COLORS = {
     'primary': '#6E8FB2',
@@ -30,6 +57,9 @@ THEME_COLORS = {
     'yellow': '#D0D63E'
 }
 
+# URL中保存基因型状态的查询参数名
+GENOTYPE_QUERY_PARAM = 'g'
+
 st.set_page_config(
     page_title="AD PRS Genome Browser",
     page_icon="🧬",
@@ -225,6 +255,147 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+def get_session_genotypes():
+    return dosages_to_genotypes(st.session_state.dosages)
+
+def set_session_genotype(rsid, genotype):
+    snp_info = SNP_DATA[rsid]
+    dosages = st.session_state.dosages.copy()
+    dosages[SNP_IDS.index(rsid)] = genotype_to_dosage(
+        genotype, snp_info['effect_allele'], snp_info['other_allele']
+    )
+    st.session_state.dosages = dosages
+
+def new_randomize_seed(target):
+    # 每次随机化使用新的系统熵种子，并记录下来以便重放：
+    # generate_realistic_genotypes(rng=seed) 或 generate_realistic_genotype(rsid, snp_info, rng=seed)
+    seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+    st.session_state.last_randomize = {'target': target, 'seed': seed}
+    return seed
+
+def restore_session_dosages():
+    token = st.query_params.get(GENOTYPE_QUERY_PARAM)
+    if token:
+        try:
+            return decode_dosage_token(token)
+        except ValueError:
+            pass
+    return genotypes_to_dosages(generate_realistic_genotypes(rng=new_randomize_seed('All SNPs')))
+
+def sync_genotype_query_param():
+    token = encode_dosage_token(st.session_state.dosages)
+    if st.query_params.get(GENOTYPE_QUERY_PARAM) != token:
+        st.query_params[GENOTYPE_QUERY_PARAM] = token
+
+@st.cache_resource
+def get_shared_snp_model():
+    # 列式模型每个进程只构建一次，所有会话共享同一份只读数据
+    return get_snp_model()
+
+@shared_asset
+def get_snp_dropdown_options():
+    # 下拉框选项与用户无关：按染色体排序的标签在进程内只生成一次
+    snp_options = ["— Select SNP —"]
+    for chrom, rsids in get_chromosome_snp_groups():
+        for rsid in rsids:
+            badge = "RISK" if SNP_DATA[rsid]['effect_weight'] > 0 else "PROT"
+            snp_options.append(f"Chr{chrom} | {rsid} | {badge}")
+    return tuple(snp_options)
+
+@st.cache_resource(show_spinner=False)
+def warm_up_shared_assets():
+    # 服务进程的首次运行时构建全部共享资源（模型、下拉框选项、参考曲线、Circos几何），之后的会话只读命中
+    return warm_shared_assets()
+
+@st.cache_data
+def get_all_model_scores(token):
+    # 一次稀疏矩阵乘法计算所有注册模型的得分，按基因型令牌缓存，切换模型时无需重算
+    model_ids, scores = calculate_model_scores(decode_dosage_token(token))
+    percentiles = calculate_model_percentiles(scores, model_ids)
+    return {model_id: (float(score), float(pct)) for model_id, score, pct in zip(model_ids, scores, percentiles)}
+
+def get_selected_model_score():
+    model_id = st.session_state.get('prs_model', DEFAULT_MODEL_ID)
+    score, percentile = get_all_model_scores(encode_dosage_token(st.session_state.dosages))[model_id]
+    return model_id, score, percentile
+
+@st.cache_data(show_spinner="Parsing raw data...")
+def parse_raw_data_file(digest, _data):
+    # 按文件内容哈希缓存，重跑时不重复解压和解析；_data不参与缓存键
+    if _data[:2] == b'\x1f\x8b':
+        _data = gzip.decompress(_data)
+    elif _data[:4] == b'PK\x03\x04':
+        with zipfile.ZipFile(io.BytesIO(_data)) as archive:
+            names = [name for name in archive.namelist() if not name.endswith('/')]
+            _data = archive.read(names[0]) if names else b''
+    return read_consumer_bytes(_data)
+
+@st.cache_resource(show_spinner=False)
+def get_cohort_preview(digest, sep, _data):
+    # 每个队列文件只在后台评分一次，所有会话共享同一个预览对象；快照随评分进度逐步替换
+    if _data[:2] == b'\x1f\x8b':
+        _data = gzip.decompress(_data)
+    total = max(_data.count(b'\n') - 1 + (not _data.endswith(b'\n')), 0)
+    return start_background_preview(iter_cohort_table_chunks(io.BytesIO(_data), sep=sep), total)
+
+def get_session_cohort_preview():
+    # 队列分布以PGS000334得分计算，只叠加在该模型的参考曲线上
+    if st.session_state.get('prs_model', DEFAULT_MODEL_ID) != DEFAULT_MODEL_ID:
+        return None
+    return st.session_state.get('cohort_preview')
+
+def add_cohort_overlay(fig, snapshot):
+    if snapshot['final']:
+        # 精确结果：服务端已将全部得分归约为固定点数的核密度曲线，图表数据量与队列规模无关
+        fig.add_trace(go.Scatter(
+            x=snapshot['kde_x'],
+            y=snapshot['kde'],
+            mode='lines',
+            line=dict(color=THEME_COLORS['accent'], width=2),
+            name='Cohort',
+            showlegend=False
+        ))
+        return
+    
+    # 评分进行中：分箱密度及其置信带
+    edges = np.asarray(snapshot['edges'])
+    centers = (edges[:-1] + edges[1:]) / 2
+    fig.add_trace(go.Scatter(x=centers, y=snapshot['density_upper'], mode='lines',
+                             line=dict(width=0, shape='hvh'), hoverinfo='skip', showlegend=False))
+    fig.add_trace(go.Scatter(x=centers, y=snapshot['density_lower'], mode='lines',
+                             line=dict(width=0, shape='hvh'), fill='tonexty',
+                             fillcolor='rgba(234, 182, 122, 0.25)', hoverinfo='skip', showlegend=False))
+    fig.add_trace(go.Scatter(
+        x=centers,
+        y=snapshot['density'],
+        mode='lines',
+        line=dict(color=THEME_COLORS['accent'], width=2, shape='hvh', dash='dot'),
+        name='Cohort (provisional)',
+        showlegend=False
+    ))
+
+def get_cohort_percentile(snapshot, score):
+    # 由直方图的累积分布线性插值；直方图覆盖理论得分范围，不存在范围外的记录
+    edges = np.asarray(snapshot['edges'])
+    cumulative = np.concatenate([[0], np.cumsum(np.asarray(snapshot['density']) * np.diff(edges))])
+    return float(np.interp(score, edges, cumulative) * 100)
+
+def render_cohort_caption(snapshot, current_prs):
+    median, median_lower, median_upper = snapshot['quantiles']['0.5']
+    cohort_percentile = get_cohort_percentile(snapshot, current_prs)
+    if snapshot['final']:
+        st.caption(f"Cohort (N={snapshot['count']:,}): median {median:.3f} · "
+                   f"you are at the {cohort_percentile:.1f}th cohort percentile")
+    else:
+        st.caption(f"Cohort preview: {snapshot['count']:,} of {snapshot['total']:,} scored · "
+                   f"median {median:.3f} ({median_lower:.3f}–{median_upper:.3f}) · "
+                   f"cohort percentile {cohort_percentile:.1f} ± {snapshot['percentile_error']:.1f}")
+
+@st.cache_data
+def get_reference_bootstrap():
+    # 固定种子：同一模型的重抽样结果在所有会话和重跑间保持一致
+    return bootstrap_reference_distribution(n_boot=2000, rng=0)
+
 def load_disclaimer():
     try:
         with open('disclaimer.md', 'r', encoding='utf-8') as file:
@@ -273,16 +444,9 @@ def show_disclaimer_page():
 def render_snp_dropdown():
     st.markdown('<div class="section-header">SNP Selection</div>', unsafe_allow_html=True)
     
-    snp_options = ["— Select SNP —"]
-    for chrom in sorted(set(info['chromosome'] for info in SNP_DATA.values()), key=int):
-        for rsid, info in SNP_DATA.items():
-            if info['chromosome'] == chrom:
-                badge = "RISK" if info['effect_weight'] > 0 else "PROT"
-                snp_options.append(f"Chr{chrom} | {rsid} | {badge}")
-    
     selected_option = st.selectbox(
         "Choose variant:",
-        snp_options,
+        get_snp_dropdown_options(),
         key="snp_dropdown",
         label_visibility="collapsed"
     )
@@ -293,12 +457,27 @@ def render_snp_dropdown():
             st.session_state.selected_snp = rsid
             st.rerun()
 
+def prerender_editor_outcomes(rsid, snp_info, options):
+    # 下一状态几乎总是应用三个基因型之一或关闭编辑器（等同于保留当前基因型）；
+    # 下拉框仍保留该SNP时重跑后会重新选中它，因此两种选中状态都预渲染，在用户决定前于后台完成
+    if 'prerender_owner' not in st.session_state:
+        st.session_state.prerender_owner = secrets.token_hex(8)
+    index = SNP_IDS.index(rsid)
+    tokens = [encode_dosage_token(st.session_state.dosages)]
+    for genotype in options:
+        dosages = st.session_state.dosages.copy()
+        dosages[index] = genotype_to_dosage(genotype, snp_info['effect_allele'], snp_info['other_allele'])
+        tokens.append(encode_dosage_token(dosages))
+    states = [(token, rsid) for token in tokens] + [(token, None) for token in tokens]
+    prerender_circos_states(states, owner=st.session_state.prerender_owner)
+
 def render_compact_editor():
     selected_snp = st.session_state.get('selected_snp', None)
     
-    if selected_snp and selected_snp in SNP_DATA:
-        snp_info = SNP_DATA[selected_snp]
-        current_genotype = st.session_state.genotypes[selected_snp]
+    model = get_shared_snp_model()
+    if selected_snp and selected_snp in model.index:
+        snp_info = model.record(model.index[selected_snp])
+        current_genotype = get_session_genotypes().get(selected_snp)
         
         CHROMOSOME_COLORS = {
             '1': '#B5C3D7', '2': '#B6C9C0', '3': '#F5D8B7', '4': '#F1D0C6',
@@ -320,6 +499,7 @@ def render_compact_editor():
         
         st.markdown("**Genotype Selection**")
         options = get_genotype_options(snp_info['effect_allele'], snp_info['other_allele'])
+        prerender_editor_outcomes(selected_snp, snp_info, options)
         
         new_genotype = st.selectbox(
             "Select genotype:",
@@ -361,7 +541,7 @@ def render_compact_editor():
         
         if new_genotype != current_genotype:
             if st.button("Apply Changes", use_container_width=True, type="primary"):
-                st.session_state.genotypes[selected_snp] = new_genotype
+                set_session_genotype(selected_snp, new_genotype)
                 st.session_state.selected_snp = None
                 st.success(f"{selected_snp} Updated")
                 st.rerun()
@@ -369,7 +549,8 @@ def render_compact_editor():
         col1, col2 = st.columns(2)
         with col1:
             if st.button("Randomize", use_container_width=True, help="MAF-based random genotype"):
-                st.session_state.genotypes[selected_snp] = generate_realistic_genotype(selected_snp, snp_info)
+                seed = new_randomize_seed(selected_snp)
+                set_session_genotype(selected_snp, generate_realistic_genotype(selected_snp, snp_info, rng=seed))
                 st.session_state.selected_snp = None
                 st.rerun()
         with col2:
@@ -386,24 +567,22 @@ def render_compact_editor():
         """, unsafe_allow_html=True)
 
 def create_percentile_chart():
-    current_prs = calculate_prs(st.session_state.genotypes)
-    
-    POPULATION_MEAN = -2.4101
-    POPULATION_STD = 0.6444
-    THEORETICAL_MIN = -5.46
-    THEORETICAL_MAX = 1.86
+    model_id, current_prs, percentile = get_selected_model_score()
+    model_info = get_model_info(model_id)
     
     from scipy.stats import norm
-    percentile = norm.cdf(current_prs, loc=POPULATION_MEAN, scale=POPULATION_STD) * 100
-    percentile = max(0.1, min(99.9, percentile))
     
     st.markdown('<div class="section-header">Population Percentile</div>', unsafe_allow_html=True)
     
+    reference_grid = get_reference_pdf_grid(model_id)
+    if reference_grid is None:
+        st.caption(f"No reference distribution available for {model_info['name']}")
+        return
+    
     fig = go.Figure()
     
-    x_min, x_max = THEORETICAL_MIN, THEORETICAL_MAX
-    x_range = np.linspace(x_min, x_max, 500)
-    y_normal = norm.pdf(x_range, loc=POPULATION_MEAN, scale=POPULATION_STD)
+    x_min, x_max = model_info['min'], model_info['max']
+    x_range, y_normal = reference_grid
     
     fig.add_trace(go.Scatter(
         x=x_range,
@@ -417,7 +596,7 @@ def create_percentile_chart():
     ))
     
     if x_min <= current_prs <= x_max:
-        user_y = norm.pdf(current_prs, loc=POPULATION_MEAN, scale=POPULATION_STD)
+        user_y = norm.pdf(current_prs, loc=model_info['mean'], scale=model_info['std'])
         
         fig.add_trace(go.Scatter(
             x=[current_prs, current_prs],
@@ -435,6 +614,11 @@ def create_percentile_chart():
             showlegend=False
         ))
     
+    cohort_preview = get_session_cohort_preview()
+    cohort_snapshot = cohort_preview.latest if cohort_preview is not None else None
+    if cohort_snapshot is not None:
+        add_cohort_overlay(fig, cohort_snapshot)
+    
     fig.update_layout(
         xaxis=dict(title="PRS Score", showgrid=True, gridcolor='rgba(0,0,0,0.05)'),
         yaxis=dict(title="Density", showgrid=False),
@@ -446,21 +630,14 @@ def create_percentile_chart():
     
     st.plotly_chart(fig, use_container_width=True, key="percentile_chart")
     
-    if percentile < 5:
-        percentile_desc = "Very Low Risk"
-        percentile_color = THEME_COLORS['success']
-    elif percentile < 25:
-        percentile_desc = "Below Average"
-        percentile_color = THEME_COLORS['info']
-    elif percentile < 75:
-        percentile_desc = "Average Range"
-        percentile_color = THEME_COLORS['muted']
-    elif percentile < 95:
-        percentile_desc = "Above Average"
-        percentile_color = THEME_COLORS['warning']
-    else:
-        percentile_desc = "Very High Risk"
-        percentile_color = THEME_COLORS['danger']
+    if cohort_snapshot is not None:
+        render_cohort_caption(cohort_snapshot, current_prs)
+    if cohort_preview is not None and cohort_preview.error is not None:
+        st.warning(f"Cohort scoring failed: {cohort_preview.error}")
+    
+    band = get_percentile_band(percentile)
+    percentile_desc = band['level']
+    percentile_color = band['color']
     
     st.markdown(f"""
     <div style="text-align: center; padding: 12px; margin-top: 8px;">
@@ -488,6 +665,13 @@ def create_percentile_chart():
     </div>
     """, unsafe_allow_html=True)
 
+def refresh_percentile_chart():
+    create_percentile_chart()
+    cohort_preview = get_session_cohort_preview()
+    if cohort_preview is None or cohort_preview.done:
+        # 队列评分已结束：整页重跑一次，停止定时刷新
+        st.rerun()
+
 def render_control_panel():
     st.markdown('<div class="section-header">Global Controls</div>', unsafe_allow_html=True)
     
@@ -495,53 +679,83 @@ def render_control_panel():
     
     with col1:
         if st.button("⟳ Randomize All", use_container_width=True):
-            st.session_state.genotypes = generate_realistic_genotypes()
+            seed = new_randomize_seed('All SNPs')
+            st.session_state.dosages = genotypes_to_dosages(generate_realistic_genotypes(rng=seed))
             st.session_state.selected_snp = None
             st.rerun()
     
     with col2:
         if st.button("↓ Minimize Risk", use_container_width=True):
-            for rsid, snp_info in SNP_DATA.items():
-                effect_allele = snp_info['effect_allele']
-                other_allele = snp_info['other_allele']
-                if snp_info['effect_weight'] < 0:
-                    st.session_state.genotypes[rsid] = effect_allele + effect_allele
-                else:
-                    st.session_state.genotypes[rsid] = other_allele + other_allele
+            weights = get_shared_snp_model().columns['effect_weight']
+            st.session_state.dosages = np.where(weights < 0, 2, 0).astype(np.int8)
             st.session_state.selected_snp = None
             st.rerun()
 
     with col3:
         if st.button("↑ Maximize Risk", use_container_width=True):
-            for rsid, snp_info in SNP_DATA.items():
-                effect_allele = snp_info['effect_allele']
-                other_allele = snp_info['other_allele']
-                if snp_info['effect_weight'] > 0:
-                    st.session_state.genotypes[rsid] = effect_allele + effect_allele
-                else:
-                    st.session_state.genotypes[rsid] = other_allele + other_allele
+            weights = get_shared_snp_model().columns['effect_weight']
+            st.session_state.dosages = np.where(weights > 0, 2, 0).astype(np.int8)
             st.session_state.selected_snp = None
             st.rerun()
-
-def render_summary_stats():
-    current_prs = calculate_prs(st.session_state.genotypes)
     
-    effect_snps = sum(1 for rsid, genotype in st.session_state.genotypes.items() 
-                     if SNP_DATA[rsid]['effect_allele'] in genotype)
+    st.selectbox("Scoring model", list(PRS_MODELS), key="prs_model",
+                 format_func=lambda model_id: PRS_MODELS[model_id]['name'])
+    
+    st.toggle("Percentile uncertainty (95% CI)", key="show_percentile_ci",
+              help="Resample allele frequencies and effect weights to estimate a credible interval")
+    
+    uploaded = st.file_uploader("Load raw data (23andMe / AncestryDNA)", type=['txt', 'csv', 'zip', 'gz'],
+                                key="raw_data_file")
+    if uploaded is not None:
+        data = uploaded.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        dosages = parse_raw_data_file(digest, data)
+        n_found = int((dosages >= 0).sum())
+        if n_found == 0:
+            st.warning("No model variants found in the uploaded file")
+        elif st.session_state.get('raw_data_digest') != digest:
+            # 只在上传新文件时覆盖当前基因型，之后的手动编辑不会被重置
+            st.session_state.raw_data_digest = digest
+            st.session_state.dosages = dosages
+            st.session_state.selected_snp = None
+            st.rerun()
+        else:
+            st.caption(f"Loaded {n_found}/{len(SNP_IDS)} model variants from {uploaded.name}")
+    
+    cohort_file = st.file_uploader("Compare with a cohort (wide TSV/CSV, one column per rsid)",
+                                   type=['tsv', 'txt', 'csv', 'gz'], key="cohort_file")
+    if cohort_file is None:
+        st.session_state.pop('cohort_preview', None)
+    else:
+        data = cohort_file.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        sep = ',' if cohort_file.name.removesuffix('.gz').endswith('.csv') else '\t'
+        cohort_preview = get_cohort_preview(digest, sep, data)
+        if st.session_state.get('cohort_preview') is not cohort_preview:
+            st.session_state.cohort_preview = cohort_preview
+            st.rerun()
+        if not cohort_preview.done:
+            st.caption("Scoring cohort in the background; the chart shows a provisional distribution")
     
-    protective_snps = sum(1 for rsid, genotype in st.session_state.genotypes.items() 
-                         if SNP_DATA[rsid]['effect_weight'] < 0 and 
-                         SNP_DATA[rsid]['effect_allele'] in genotype)
+    last_randomize = st.session_state.get('last_randomize')
+    if last_randomize:
+        st.caption(f"Last randomize ({last_randomize['target']}) seed: {last_randomize['seed']}")
+
+def render_summary_stats():
+    model_id, current_prs, percentile = get_selected_model_score()
     
-    risk_snps = sum(1 for rsid, genotype in st.session_state.genotypes.items() 
-                   if SNP_DATA[rsid]['effect_weight'] > 0 and 
-                   SNP_DATA[rsid]['effect_allele'] in genotype)
+    # 直接在剂量数组上按所选模型的权重符号统计携带效应等位基因的SNP，不在模型中的变异不计入
+    model_weights, _ = get_aligned_model_weights(SNP_IDS, model_id)
+    effect_snps, risk_snps, protective_snps = (
+        int(count) for count in count_effect_snps_batch(st.session_state.dosages, model_weights)
+    )
     
-    from scipy.stats import norm
-    POPULATION_MEAN = -2.4101
-    POPULATION_STD = 0.6444
-    percentile = norm.cdf(current_prs, loc=POPULATION_MEAN, scale=POPULATION_STD) * 100
-    percentile = max(0.1, min(99.9, percentile))
+    percentile_ci = ""
+    # 参考分布的重抽样只针对PGS000334
+    if st.session_state.get('show_percentile_ci', False) and model_id == DEFAULT_MODEL_ID:
+        reference_means, reference_stds = get_reference_bootstrap()
+        ci_lower, ci_upper = calculate_percentile_interval(current_prs, reference_means, reference_stds)
+        percentile_ci = f'<div style="font-size: 0.7rem; color: {THEME_COLORS["muted"]};">95% CI {ci_lower:.1f}–{ci_upper:.1f}%</div>'
     
     col1, col2, col3, col4 = st.columns(4)
     
@@ -557,6 +771,7 @@ def render_summary_stats():
         st.markdown(f"""
         <div class="stat-card-glass">
             <div class="stat-value" style="color: {THEME_COLORS['accent']}; font-size: 1.5rem; margin-bottom: 0.2rem;">{percentile:.1f}%</div>
+            {percentile_ci}
             <div class="stat-label" style="font-size: 0.75rem;">PERCENTILE</div>
         </div>
         """, unsafe_allow_html=True)
@@ -595,11 +810,16 @@ def show_app_content():
     with col_select:
         render_snp_dropdown()
         st.markdown("---")
-        create_percentile_chart()
+        cohort_preview = get_session_cohort_preview()
+        if cohort_preview is not None and not cohort_preview.done:
+            # 队列仍在后台评分：以片段方式每秒重绘百分位图，只刷新这一部分
+            st.fragment(run_every=1.0)(refresh_percentile_chart)()
+        else:
+            create_percentile_chart()
     
     with col_circos:
         display_circos_in_streamlit(
-            st.session_state.genotypes, 
+            get_session_genotypes(), 
             st.session_state.get('selected_snp', None)
         )
     
@@ -623,16 +843,19 @@ def show_app_content():
     """, unsafe_allow_html=True)
       
 def main():
+    warm_up_shared_assets()
+    
     if 'disclaimer_accepted' not in st.session_state:
         st.session_state.disclaimer_accepted = False
     
     if not st.session_state.disclaimer_accepted:
         show_disclaimer_page()
     else:
-        if 'genotypes' not in st.session_state:
-            st.session_state.genotypes = generate_realistic_genotypes()
+        if 'dosages' not in st.session_state:
+            st.session_state.dosages = restore_session_dosages()
         if 'selected_snp' not in st.session_state:
             st.session_state.selected_snp = None
+        sync_genotype_query_param()
         
         show_app_content()
 
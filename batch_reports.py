@@ -0,0 +1,225 @@
+import argparse
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')  # 无界面后端，需在导入pyplot之前设置
+import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba_array
+import numpy as np
+
+from prs_core import (
+    SNP_IDS,
+    POPULATION_MEAN,
+    POPULATION_STD,
+    THEORETICAL_MIN,
+    THEORETICAL_MAX,
+    calculate_prs_batch,
+    calculate_percentile,
+    count_effect_snps_batch,
+    get_effect_weights,
+    get_reference_pdf_grid,
+    get_risk_interpretation,
+    simulate_cohort_dosages
+)
+from circos_visualization import (
+    THEME_COLORS,
+    draw_chromosome_ring,
+    draw_partial_score_track,
+    get_chromosome_partial_scores,
+    get_circos_geometry,
+    update_partial_score_track
+)
+
+REPORT_FORMATS = ('png', 'svg', 'pdf')
+
+class ReportTemplate:
+    """
+    可复用的个人报告图模板（Circos环 + 百分位曲线 + 汇总统计）
+    静态元素只绘制一次，每个样本只更新SNP透明度、文字和百分位标记
+    """
+
+    def __init__(self, dpi=100):
+        self.dpi = dpi
+        self.fig = plt.figure(figsize=(11, 6))
+        grid = self.fig.add_gridspec(2, 2, width_ratios=[1.2, 1], height_ratios=[1, 1])
+        self.ax_circos = self.fig.add_subplot(grid[:, 0], projection='polar')
+        self.ax_curve = self.fig.add_subplot(grid[0, 1])
+        self.ax_stats = self.fig.add_subplot(grid[1, 1])
+
+        self._build_circos()
+        self._build_percentile_curve()
+        self._build_stats_panel()
+        self.title = self.fig.suptitle('', fontsize=12, fontweight='bold', color=THEME_COLORS['dark'])
+
+    def _build_circos(self):
+        ax = self.ax_circos
+        draw_chromosome_ring(ax)
+        self.partial_bars = draw_partial_score_track(ax, {})
+
+        geometry = get_circos_geometry()
+        self.base_colors = to_rgba_array(
+            [THEME_COLORS['danger'] if w > 0 else THEME_COLORS['info'] for w in get_effect_weights()]
+        )
+        self.snp_points = ax.scatter(geometry['snp_angles'], np.full(len(SNP_IDS), 0.7), s=geometry['snp_sizes'],
+                                     c=self.base_colors, zorder=10,
+                                     edgecolors='white', linewidths=1.5)
+
+        ax.set_ylim(0, 1.0)
+        ax.set_yticklabels([])
+        ax.set_xticklabels([])
+        ax.grid(False)
+        ax.spines['polar'].set_visible(False)
+
+        self.prs_text = ax.text(0, 0, '', ha='center', va='center',
+                                fontsize=12, fontweight='bold', color=THEME_COLORS['primary'],
+                                bbox=dict(boxstyle="round,pad=0.25", facecolor='white',
+                                          edgecolor=THEME_COLORS['primary'], linewidth=2))
+        self.effect_text = ax.text(0, -0.12, '', ha='center', va='center',
+                                   fontsize=9, color=THEME_COLORS['muted'],
+                                   bbox=dict(boxstyle="round,pad=0.15", facecolor='white',
+                                             edgecolor=THEME_COLORS['muted']))
+
+        legend_elements = [
+            plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=THEME_COLORS['danger'],
+                       markersize=7, alpha=0.8, label='Risk SNPs'),
+            plt.Line2D([0], [0], marker='o', color='w', markerfacecolor=THEME_COLORS['info'],
+                       markersize=7, alpha=0.8, label='Protective SNPs')
+        ]
+        ax.legend(handles=legend_elements, loc='upper left', bbox_to_anchor=(-0.1, 1.0), fontsize=8)
+
+    def _build_percentile_curve(self):
+        ax = self.ax_curve
+        x_range, y_normal = get_reference_pdf_grid()
+        ax.plot(x_range, y_normal, color=THEME_COLORS['info'], linewidth=2)
+        ax.fill_between(x_range, y_normal, color=THEME_COLORS['info'], alpha=0.3)
+        self.marker_line, = ax.plot([], [], color=THEME_COLORS['primary'], linewidth=3)
+        self.marker_point, = ax.plot([], [], 'o', markersize=8, color=THEME_COLORS['primary'])
+        ax.set_xlim(THEORETICAL_MIN, THEORETICAL_MAX)
+        ax.set_ylim(0, y_normal.max() * 1.1)
+        ax.set_xlabel("PRS Score")
+        ax.set_ylabel("Density")
+        ax.set_title("Population Percentile", fontsize=10, color=THEME_COLORS['dark'])
+        ax.spines[['top', 'right']].set_visible(False)
+
+    def _build_stats_panel(self):
+        ax = self.ax_stats
+        ax.axis('off')
+        self.stats_text = ax.text(0.05, 0.95, '', ha='left', va='top', fontsize=10,
+                                  family='monospace', color=THEME_COLORS['dark'],
+                                  transform=ax.transAxes)
+
+    def update(self, sample_id, dosages, prs, percentile, effect_snps, risk_snps, protective_snps):
+        from scipy.stats import norm
+
+        # 与create_circos_plot一致：透明度随效应等位基因数增加
+        colors = self.base_colors.copy()
+        colors[:, 3] = 0.5 + 0.25 * np.clip(dosages, 0, 2)
+        self.snp_points.set_facecolor(colors)
+        update_partial_score_track(self.partial_bars, get_chromosome_partial_scores(dosages))
+
+        self.prs_text.set_text(f"PRS\n{prs:.3f}")
+        self.effect_text.set_text(f"Effect SNPs: {effect_snps}/{len(SNP_IDS)}")
+
+        if THEORETICAL_MIN <= prs <= THEORETICAL_MAX:
+            user_y = norm.pdf(prs, loc=POPULATION_MEAN, scale=POPULATION_STD)
+            self.marker_line.set_data([prs, prs], [0, user_y])
+            self.marker_point.set_data([prs], [user_y])
+        else:
+            self.marker_line.set_data([], [])
+            self.marker_point.set_data([], [])
+
+        risk = get_risk_interpretation(prs)
+        self.stats_text.set_text(
+            f"PRS score        {prs:.3f}\n"
+            f"Percentile       {percentile:.1f}%\n"
+            f"Risk level       {risk['level']}\n"
+            f"Risk SNPs        {risk_snps}\n"
+            f"Protective SNPs  {protective_snps}"
+        )
+        self.stats_text.set_color(risk['color'])
+        self.title.set_text(f"Sample {sample_id}")
+
+    def save(self, path_stem, formats):
+        for fmt in formats:
+            self.fig.savefig(f"{path_stem}.{fmt}", format=fmt, dpi=self.dpi)
+
+# 每个工作进程持有一个模板，避免为每个样本重建图形
+_worker_template = None
+
+def _init_worker(dpi):
+    global _worker_template
+    _worker_template = ReportTemplate(dpi)
+
+def _safe_filename(sample_id):
+    return re.sub(r'[^A-Za-z0-9._-]', '_', str(sample_id))
+
+def _render_chunk(output_dir, formats, sample_ids, dosages, prs, percentiles, effect_counts):
+    effect_snps, risk_snps, protective_snps = effect_counts
+    for i, sample_id in enumerate(sample_ids):
+        _worker_template.update(sample_id, dosages[i], prs[i], percentiles[i],
+                                effect_snps[i], risk_snps[i], protective_snps[i])
+        _worker_template.save(os.path.join(output_dir, _safe_filename(sample_id)), formats)
+    return len(sample_ids)
+
+def render_cohort_reports(sample_ids, dosages, output_dir, formats=('png',), workers=None,
+                          chunk_size=64, dpi=100):
+    """
+    用进程池为队列中每个样本渲染报告图，返回(报告数, 耗时秒数)
+    """
+    unknown = set(formats) - set(REPORT_FORMATS)
+    if unknown:
+        raise ValueError(f"Unsupported report formats: {sorted(unknown)}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 评分在主进程中批量完成，工作进程只负责绘图
+    prs = calculate_prs_batch(dosages)
+    percentiles = calculate_percentile(prs)
+    effect_counts = count_effect_snps_batch(dosages)
+
+    start = time.perf_counter()
+    n_reports = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(dpi,)) as executor:
+        futures = []
+        for lo in range(0, len(sample_ids), chunk_size):
+            hi = lo + chunk_size
+            futures.append(executor.submit(
+                _render_chunk, output_dir, tuple(formats), sample_ids[lo:hi], dosages[lo:hi],
+                prs[lo:hi], percentiles[lo:hi], tuple(counts[lo:hi] for counts in effect_counts)
+            ))
+        for future in futures:
+            n_reports += future.result()
+
+    return n_reports, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Render per-participant PRS report images for a cohort")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--cohort', help="Wide cohort table (sample ID column + one column per rsid)")
+    source.add_argument('--simulate', type=int, metavar='N', help="Simulate N samples from the model MAFs")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed for --simulate")
+    parser.add_argument('--output-dir', default='reports')
+    parser.add_argument('--format', nargs='+', default=['png'], choices=REPORT_FORMATS)
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--chunk-size', type=int, default=64)
+    parser.add_argument('--dpi', type=int, default=100)
+    args = parser.parse_args()
+
+    if args.cohort:
+        from genotype_io import read_cohort_table
+        sample_ids, dosages = read_cohort_table(args.cohort)
+    else:
+        dosages = simulate_cohort_dosages(args.simulate, args.seed)
+        sample_ids = [f"SIM{i:07d}" for i in range(args.simulate)]
+
+    n_reports, elapsed = render_cohort_reports(
+        sample_ids, dosages, args.output_dir, args.format,
+        workers=args.workers, chunk_size=args.chunk_size, dpi=args.dpi
+    )
+    print(f"Rendered {n_reports} reports ({', '.join(args.format)}) in {elapsed:.2f} s "
+          f"- {n_reports / elapsed:.1f} reports/s")
+
+if __name__ == "__main__":
+    main()
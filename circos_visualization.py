@@ -1,6 +1,23 @@
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+
 import numpy as np
 import matplotlib.pyplot as plt
-from prs_core import SNP_DATA, calculate_prs
+from matplotlib.figure import Figure
+from prs_core import (
+    calculate_prs,
+    calculate_partial_scores,
+    count_effect_snps_batch,
+    decode_dosage_token,
+    dosages_to_genotypes,
+    encode_dosage_token,
+    genotypes_to_dosages,
+    get_snp_model,
+    shared_asset
+)
 import streamlit as st
 
 # 染色体长度信息
@@ -37,30 +54,73 @@ THEME_COLORS = {
     'muted': '#6C757D'
 }
 
-def create_circos_plot(genotypes, selected_snp=None, figsize=(6, 6)):
+@shared_asset
+def compute_chromosome_layout():
     """
-    创建优化的Circos图
+    计算每条染色体的起始角度和角度跨度（从12点钟方向开始顺时针排列），进程内共享只读
     """
-    fig, ax = plt.subplots(figsize=figsize, subplot_kw=dict(projection='polar'))
-    
-    # 计算总长度
     total_length = sum(CHROMOSOME_LENGTHS.values())
-    
-    # 从12点钟方向开始，顺时针排列
+    layout = {}
     current_angle = np.pi / 2
-    
-    # 绘制所有22条染色体，形成完整圆形
     for chrom in sorted(CHROMOSOME_LENGTHS.keys(), key=int):
-        chrom_length = CHROMOSOME_LENGTHS[chrom]
-        angle_span = (chrom_length / total_length) * 2 * np.pi
-        end_angle = current_angle - angle_span
-        
-        # 绘制染色体弧
-        theta = np.linspace(current_angle, end_angle, 30)
+        angle_span = (CHROMOSOME_LENGTHS[chrom] / total_length) * 2 * np.pi
+        layout[chrom] = (current_angle, angle_span)
+        current_angle -= angle_span
+    return MappingProxyType(layout)
+
+@shared_asset
+def get_circos_geometry():
+    """
+    Circos图中与用户无关的几何数据，进程内只构建一次：染色体弧的角度采样和标签位置、
+    部分得分轨道的柱位置和宽度、按模型顺序排列的SNP角度和点大小，以及按染色体排序的绘制顺序
+    """
+    layout = compute_chromosome_layout()
+    model = get_snp_model()
+
+    arcs = {}
+    for chrom, (start_angle, angle_span) in layout.items():
+        end_angle = start_angle - angle_span
+        arcs[chrom] = (np.linspace(start_angle, end_angle, 30), (start_angle + end_angle) / 2)
+
+    spans = np.array([layout[chrom][1] for chrom in CHROMOSOME_LENGTHS])
+    mids = np.array([layout[chrom][0] for chrom in CHROMOSOME_LENGTHS]) - spans / 2
+
+    # SNP角度 = 染色体起始角度 - 相对位置 × 染色体角度跨度
+    chromosomes = model.values['chromosome']
+    starts = np.array([layout[chrom][0] for chrom in chromosomes])
+    chrom_spans = np.array([layout[chrom][1] for chrom in chromosomes])
+    lengths = np.array([CHROMOSOME_LENGTHS[chrom] for chrom in chromosomes], dtype=np.float64)
+    snp_angles = starts - (model.columns['position'] / lengths * chrom_spans)
+
+    geometry = {
+        'layout': layout,
+        'arcs': MappingProxyType(arcs),
+        'snp_chromosomes': frozenset(chromosomes),
+        'track_mids': mids,
+        'track_widths': spans * 0.85,
+        'track_baseline': np.linspace(0, 2 * np.pi, 200),
+        'snp_order': np.argsort(model.columns['chromosome_code'], kind='stable'),
+        'snp_angles': snp_angles,
+        'snp_sizes': np.clip(np.abs(model.columns['effect_weight']) * 300, 40, 150)
+    }
+    # 所有会话共享同一份数组，设为只读
+    for theta, _ in arcs.values():
+        theta.setflags(write=False)
+    for value in geometry.values():
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+    return MappingProxyType(geometry)
+
+def draw_chromosome_ring(ax):
+    """
+    绘制22条染色体组成的完整圆环及标签
+    """
+    geometry = get_circos_geometry()
+    for chrom, (theta, mid_angle) in geometry['arcs'].items():
         r_inner, r_outer = 0.75, 0.9
         
         # 检查是否有SNP决定颜色
-        has_snp = any(snp['chromosome'] == chrom for snp in SNP_DATA.values())
+        has_snp = chrom in geometry['snp_chromosomes']
         if has_snp:
             color = CHROMOSOME_COLORS.get(chrom, '#CCCCCC')
             alpha = 0.8
@@ -73,82 +133,132 @@ def create_circos_plot(genotypes, selected_snp=None, figsize=(6, 6)):
                        edgecolor='white', linewidth=0.8)
         
         # 为所有染色体添加标签
-        mid_angle = (current_angle + end_angle) / 2
         label_r = 0.95
         ax.text(mid_angle, label_r, f"Chr{chrom}", 
                ha='center', va='center', fontsize=6, 
                weight='bold' if has_snp else 'normal',
                color='#333333' if has_snp else '#666666')
-        
-        current_angle = end_angle
+
+# 染色体部分得分直方图轨道：基线半径和最大柱高（风险向外、保护向内）
+PARTIAL_TRACK_RADIUS = 0.55
+PARTIAL_TRACK_HEIGHT = 0.1
+
+def scale_partial_scores(chrom_scores):
+    """
+    将每条染色体的部分得分按本图最大绝对值缩放为直方图柱高
+    """
+    scores = np.array([chrom_scores.get(chrom, 0.0) for chrom in CHROMOSOME_LENGTHS], dtype=np.float64)
+    max_abs = np.abs(scores).max()
+    if max_abs == 0:
+        return np.zeros_like(scores)
+    return scores / max_abs * PARTIAL_TRACK_HEIGHT
+
+def draw_partial_score_track(ax, chrom_scores):
+    """
+    在环内绘制每条染色体部分PRS的直方图轨道，返回柱子列表以便更新
+    """
+    geometry = get_circos_geometry()
+    heights = scale_partial_scores(chrom_scores)
+    colors = [THEME_COLORS['danger'] if h > 0 else THEME_COLORS['info'] for h in heights]
+
+    theta = geometry['track_baseline']
+    ax.plot(theta, np.full_like(theta, PARTIAL_TRACK_RADIUS), color='#DDDDDD', linewidth=0.6, zorder=1)
+    bars = ax.bar(geometry['track_mids'], heights, width=geometry['track_widths'], bottom=PARTIAL_TRACK_RADIUS,
+                  color=colors, alpha=0.85, edgecolor='white', linewidth=0.5, zorder=2)
+    return list(bars)
+
+def update_partial_score_track(bars, chrom_scores):
+    """
+    用新的部分得分更新已绘制的直方图柱高和颜色
+    """
+    for bar, height in zip(bars, scale_partial_scores(chrom_scores)):
+        bar.set_height(height)
+        bar.set_facecolor(THEME_COLORS['danger'] if height > 0 else THEME_COLORS['info'])
+
+def get_chromosome_partial_scores(dosages):
+    """
+    计算每条染色体的部分PRS，返回{染色体: 得分}
+    """
+    labels, partial = calculate_partial_scores(dosages, level='chromosome')
+    return dict(zip(labels, partial))
+
+def create_circos_plot(genotypes, selected_snp=None, figsize=(6, 6)):
+    """
+    创建优化的Circos图
+    """
+    # 不经过pyplot的全局图形管理器，可在后台线程中安全渲染
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot(projection='polar')
     
-    # 绘制SNP点（现在带有更丰富的注释信息）
-    current_angle = np.pi / 2
+    # 绘制所有22条染色体，形成完整圆形
+    draw_chromosome_ring(ax)
     
-    for chrom in sorted(CHROMOSOME_LENGTHS.keys(), key=int):
-        chrom_length = CHROMOSOME_LENGTHS[chrom]
-        angle_span = (chrom_length / total_length) * 2 * np.pi
-        end_angle = current_angle - angle_span
+    # 绘制每条染色体的部分得分直方图轨道
+    dosages = genotypes_to_dosages(genotypes)
+    draw_partial_score_track(ax, get_chromosome_partial_scores(dosages))
+    
+    # 绘制SNP点（现在带有更丰富的注释信息）
+    # 按染色体顺序（同一染色体内保持模型顺序）遍历模型变异，角度和点大小取自共享几何
+    model = get_snp_model()
+    geometry = get_circos_geometry()
+    for i in geometry['snp_order']:
+        rsid = model.rsids[i]
+        snp_info = model.record(i)
+        chrom = snp_info['chromosome']
+        position = snp_info['position']
+        effect_weight = snp_info['effect_weight']
+        snp_angle = geometry['snp_angles'][i]
+        
+        current_genotype = genotypes.get(rsid, 'Unknown')
+        
+        if effect_weight > 0:
+            color = THEME_COLORS['danger']
+            effect_type = 'Risk'
+        else:
+            color = THEME_COLORS['info']
+            effect_type = 'Protective'
         
-        for rsid, snp_info in SNP_DATA.items():
-            if snp_info['chromosome'] == chrom:
-                position = snp_info['position']
-                effect_weight = snp_info['effect_weight']
-                relative_pos = position / CHROMOSOME_LENGTHS[chrom]
-                snp_angle = current_angle - (relative_pos * angle_span)
-                
-                current_genotype = genotypes.get(rsid, 'Unknown')
-                
-                if effect_weight > 0:
-                    color = THEME_COLORS['danger']
-                    effect_type = 'Risk'
-                else:
-                    color = THEME_COLORS['info']
-                    effect_type = 'Protective'
-                
-                size = max(40, min(150, abs(effect_weight) * 300))
-                
-                if rsid == selected_snp:
-                    color = THEME_COLORS['accent']
-                    size *= 1.3
-                    edge_color = THEME_COLORS['primary']
-                    edge_width = 3
-                    alpha = 1.0
-                    zorder = 100
-                else:
-                    edge_color = 'white'
-                    edge_width = 1.5
-                    zorder = 10
-                    
-                    effect_allele_count = current_genotype.count(snp_info['effect_allele'])
-                    alpha = 0.5 + 0.25 * effect_allele_count
-                
-                # 绘制SNP点
-                scatter = ax.scatter(snp_angle, 0.7, s=size, c=color, 
-                          alpha=alpha, zorder=zorder,
-                          edgecolors=edge_color, linewidths=edge_width)
-                
-                # 为选中的SNP添加详细标注
-                if rsid == selected_snp:
-                    annotation_text = (f"{rsid}\n"
-                                     f"Gene: {snp_info.get('locus_name', 'Unknown')}\n"
-                                     f"Genotype: {current_genotype}\n"
-                                     f"Effect: {effect_weight:+.3f} ({effect_type})\n"
-                                     f"Chr{chrom}:{position:,}")
-                    
-                    ax.annotate(annotation_text,
-                               xy=(snp_angle, 0.7), xycoords='data',
-                               xytext=(0.4, 0.4), textcoords='data',
-                               fontsize=8, ha='center', va='center',
-                               bbox=dict(boxstyle="round,pad=0.3", 
-                                        facecolor='white', 
-                                        edgecolor=THEME_COLORS['primary'],
-                                        alpha=0.9),
-                               arrowprops=dict(arrowstyle='->', 
-                                             connectionstyle='arc3,rad=0.2',
-                                             color=THEME_COLORS['primary']))
+        size = geometry['snp_sizes'][i]
         
-        current_angle = end_angle
+        if rsid == selected_snp:
+            color = THEME_COLORS['accent']
+            size *= 1.3
+            edge_color = THEME_COLORS['primary']
+            edge_width = 3
+            alpha = 1.0
+            zorder = 100
+        else:
+            edge_color = 'white'
+            edge_width = 1.5
+            zorder = 10
+            
+            effect_allele_count = current_genotype.count(snp_info['effect_allele'])
+            alpha = 0.5 + 0.25 * effect_allele_count
+        
+        # 绘制SNP点
+        scatter = ax.scatter(snp_angle, 0.7, s=size, c=color, 
+                  alpha=alpha, zorder=zorder,
+                  edgecolors=edge_color, linewidths=edge_width)
+        
+        # 为选中的SNP添加详细标注
+        if rsid == selected_snp:
+            annotation_text = (f"{rsid}\n"
+                             f"Gene: {snp_info.get('locus_name', 'Unknown')}\n"
+                             f"Genotype: {current_genotype}\n"
+                             f"Effect: {effect_weight:+.3f} ({effect_type})\n"
+                             f"Chr{chrom}:{position:,}")
+            
+            ax.annotate(annotation_text,
+                       xy=(snp_angle, 0.7), xycoords='data',
+                       xytext=(0.4, 0.4), textcoords='data',
+                       fontsize=8, ha='center', va='center',
+                       bbox=dict(boxstyle="round,pad=0.3", 
+                                facecolor='white', 
+                                edgecolor=THEME_COLORS['primary'],
+                                alpha=0.9),
+                       arrowprops=dict(arrowstyle='->', 
+                                     connectionstyle='arc3,rad=0.2',
+                                     color=THEME_COLORS['primary']))
     
     # 设置图形范围
     ax.set_ylim(0, 1.0)
@@ -159,8 +269,7 @@ def create_circos_plot(genotypes, selected_snp=None, figsize=(6, 6)):
     
     # 添加中心信息
     current_prs = calculate_prs(genotypes)
-    effect_snps = sum(1 for rsid, genotype in genotypes.items() 
-                     if SNP_DATA[rsid]['effect_allele'] in genotype)
+    effect_snps = int(count_effect_snps_batch(dosages)[0])
     
     ax.text(0, 0, f"PRS\n{current_prs:.3f}", ha='center', va='center',
            fontsize=12, fontweight='bold', color=THEME_COLORS['primary'],
@@ -189,6 +298,107 @@ def create_circos_plot(genotypes, selected_snp=None, figsize=(6, 6)):
     
     return fig
 
+# ---------------------------------------------------------------------------
+# Circos图缓存与预渲染：渲染结果按(基因型令牌, 选中SNP)缓存为PNG，进程内所有会话共享；
+# 编辑器打开时在后台线程池中预渲染下一步可能出现的状态，应用修改后可直接显示
+# ---------------------------------------------------------------------------
+
+# 与st.pyplot默认的savefig参数一致
+CIRCOS_SAVEFIG_OPTIONS = {'bbox_inches': 'tight', 'dpi': 200, 'format': 'png'}
+CIRCOS_CACHE_SIZE = 64
+PRERENDER_WORKERS = 2
+# 排队（尚未开始）的预渲染上限：每个发起者最多一次编辑器的全部候选状态，全进程合计不超过此数，
+# 超出时新的预渲染直接丢弃，避免并发会话的猜测任务相互堆积
+PRERENDER_QUEUE_PER_OWNER = 8
+PRERENDER_QUEUE_LIMIT = 16
+
+_figure_cache = OrderedDict()   # (令牌, 选中SNP) -> PNG字节，按最近使用排序
+_pending_renders = {}           # (令牌, 选中SNP) -> (Future, 发起者)
+_cache_lock = threading.Lock()
+_prerender_pool = None
+
+def render_circos_png(token, selected_snp=None, figsize=(6, 6)):
+    """
+    按基因型令牌渲染Circos图，返回PNG字节
+    """
+    fig = create_circos_plot(dosages_to_genotypes(decode_dosage_token(token)), selected_snp, figsize)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, **CIRCOS_SAVEFIG_OPTIONS)
+    return buffer.getvalue()
+
+def _store_rendered(key, png):
+    with _cache_lock:
+        _figure_cache[key] = png
+        _figure_cache.move_to_end(key)
+        while len(_figure_cache) > CIRCOS_CACHE_SIZE:
+            _figure_cache.popitem(last=False)
+        _pending_renders.pop(key, None)
+
+def _prerender(key):
+    try:
+        png = render_circos_png(*key)
+    except Exception:
+        with _cache_lock:
+            _pending_renders.pop(key, None)
+        raise
+    _store_rendered(key, png)
+    return png
+
+def get_circos_png(token, selected_snp=None):
+    """
+    取Circos图PNG：命中缓存直接返回，预渲染已在运行则等待其完成，否则同步渲染并缓存；
+    尚在排队的预渲染会被取消，当前需要显示的状态不排在其他会话的预渲染之后
+    """
+    key = (token, selected_snp)
+    with _cache_lock:
+        png = _figure_cache.get(key)
+        if png is not None:
+            _figure_cache.move_to_end(key)
+            return png
+        pending = _pending_renders.get(key)
+
+    if pending is not None:
+        future = pending[0]
+        if future.cancel():
+            with _cache_lock:
+                if _pending_renders.get(key, (None,))[0] is future:
+                    del _pending_renders[key]
+        else:
+            try:
+                return future.result()
+            except Exception:
+                pass  # 预渲染失败时退回同步渲染，错误由调用方显示
+    png = render_circos_png(token, selected_snp)
+    _store_rendered(key, png)
+    return png
+
+def prerender_circos_states(states, owner=None):
+    """
+    在后台线程池中预渲染候选状态[(令牌, 选中SNP)]，按给出的顺序提交；已缓存或正在渲染的状态跳过，
+    同一发起者此前提交但尚未开始的预渲染会被取消；排队数达到PRERENDER_QUEUE_PER_OWNER或
+    PRERENDER_QUEUE_LIMIT后其余状态不再预渲染
+    """
+    global _prerender_pool
+    states = list(dict.fromkeys(states))
+    with _cache_lock:
+        if _prerender_pool is None:
+            _prerender_pool = ThreadPoolExecutor(max_workers=PRERENDER_WORKERS,
+                                                 thread_name_prefix='circos-prerender')
+        for key, (future, key_owner) in list(_pending_renders.items()):
+            if key_owner == owner and key not in states and future.cancel():
+                del _pending_renders[key]
+        queued = [key_owner for future, key_owner in _pending_renders.values()
+                  if not future.running() and not future.done()]
+        n_queued, n_owner_queued = len(queued), queued.count(owner)
+        for key in states:
+            if key in _figure_cache or key in _pending_renders:
+                continue
+            if n_queued >= PRERENDER_QUEUE_LIMIT or n_owner_queued >= PRERENDER_QUEUE_PER_OWNER:
+                break
+            _pending_renders[key] = (_prerender_pool.submit(_prerender, key), owner)
+            n_queued += 1
+            n_owner_queued += 1
+
 def display_circos_in_streamlit(genotypes, selected_snp=None):
     """
     在Streamlit中显示Circos图 - 使用容器控制大小
@@ -198,9 +408,8 @@ def display_circos_in_streamlit(genotypes, selected_snp=None):
         col1, col_circos, col2 = st.columns([0.1, 1, 0.1])
         with col_circos:
             try:
-                fig = create_circos_plot(genotypes, selected_snp, figsize=(6, 6))
-                st.pyplot(fig, use_container_width=True)
-                plt.close(fig)
+                token = encode_dosage_token(genotypes_to_dosages(genotypes))
+                st.image(get_circos_png(token, selected_snp), use_container_width=True)
             except Exception as e:
                 st.error(f"Circos visualization error: {str(e)}")
                 st.info("Please check your Python environment and dependencies.")
@@ -0,0 +1,500 @@
+import argparse
+import contextlib
+import gzip
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from prs_core import (
+    SNP_IDS,
+    DENSITY_GRID_SIZE,
+    PERCENTILE_BANDS,
+    RISK_TIERS,
+    UNKNOWN_CATEGORY_CODE,
+    ScoreHistogram,
+    ScoreReservoir,
+    ScoreSummary,
+    calculate_prs_imputed,
+    calculate_prs_qc,
+    classify_scores,
+    describe_partial_distribution,
+    get_category,
+    get_effect_weights,
+    simulate_cohort_dosages,
+    MISSING_DOSAGE
+)
+from genotype_io import (
+    build_coordinate_index,
+    iter_line_chunks,
+    parse_vcf_header,
+    peek_format,
+    read_consumer_dosages,
+    tsv_lines_to_dosages,
+    vcf_lines_to_model_dosages
+)
+
+def _require_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Arrow/Parquet export requires pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+def iter_cohort_chunks(sample_ids, dosages, chunk_size=100_000):
+    """按块切分内存中的队列，生成(样本ID, 剂量矩阵)"""
+    for lo in range(0, len(sample_ids), chunk_size):
+        yield sample_ids[lo:lo + chunk_size], dosages[lo:lo + chunk_size]
+
+def score_chunk(sample_ids, dosages, include_contributions=False):
+    """
+    对一个样本块评分（缺失基因型按期望剂量填补），返回列名到NumPy数组的有序字典；
+    QC指标（检出率、杂合率、效应等位基因计数及离群标记）在评分的同一次遍历中得到
+    """
+    prs, qc = calculate_prs_qc(dosages)
+    percentile, risk_tier, percentile_band = classify_scores(prs)
+    columns = {
+        'sample_id': np.asarray(sample_ids, dtype=object),
+        'prs': prs,
+        'percentile': percentile,
+        'risk_tier': risk_tier,
+        'percentile_band': percentile_band,
+        **qc
+    }
+    if include_contributions:
+        valid = (dosages >= 0) & (dosages <= 2)
+        contributions = np.where(valid, dosages, 0) * get_effect_weights()
+        for j, rsid in enumerate(SNP_IDS):
+            columns[f'contrib_{rsid}'] = contributions[:, j]
+    return columns
+
+def score_cohort(chunks, include_contributions=False):
+    """逐块评分，生成每块的结果列"""
+    for sample_ids, dosages in chunks:
+        yield score_chunk(sample_ids, dosages, include_contributions)
+
+def get_result_schema(include_contributions=False):
+    """评分结果的Arrow schema；风险分层为字典编码列"""
+    pa = _require_pyarrow()
+    fields = [
+        pa.field('sample_id', pa.string()),
+        pa.field('prs', pa.float64()),
+        pa.field('percentile', pa.float64()),
+        pa.field('risk_tier', pa.dictionary(pa.int8(), pa.string())),
+        pa.field('percentile_band', pa.dictionary(pa.int8(), pa.string())),
+        pa.field('call_rate', pa.float64()),
+        pa.field('high_missingness', pa.bool_()),
+        pa.field('het_rate', pa.float64()),
+        pa.field('het_outlier', pa.bool_()),
+        pa.field('effect_allele_count', pa.int32()),
+        pa.field('effect_allele_outlier', pa.bool_()),
+        pa.field('effect_snps', pa.int32()),
+        pa.field('risk_snps', pa.int32()),
+        pa.field('protective_snps', pa.int32())
+    ]
+    if include_contributions:
+        fields += [pa.field(f'contrib_{rsid}', pa.float64()) for rsid in SNP_IDS]
+    return pa.schema(fields)
+
+# 字典编码列及其标签表
+CATEGORY_TABLES = {
+    'risk_tier': RISK_TIERS,
+    'percentile_band': PERCENTILE_BANDS
+}
+
+def columns_to_record_batch(columns, schema):
+    """将结果列转换为Arrow RecordBatch；数值列直接包装NumPy缓冲区，不复制"""
+    pa = _require_pyarrow()
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if field.name in CATEGORY_TABLES:
+            labels = pa.array([entry['level'] for entry in CATEGORY_TABLES[field.name]], type=pa.string())
+            # 得分缺失的记录（UNKNOWN_CATEGORY_CODE）写为空值，而不是某个分层
+            indices = pa.array(values, type=pa.int8(), mask=values == UNKNOWN_CATEGORY_CODE)
+            arrays.append(pa.DictionaryArray.from_arrays(indices, labels))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def iter_record_batches(chunks, include_contributions=False, summary=None, preview=None):
+    """
+    逐块评分并生成Arrow RecordBatch；给定summary时同时用每块的得分更新它，
+    给定preview（ProgressivePreview）时每块更新预览，全部评分后发布精确结果
+    """
+    schema = get_result_schema(include_contributions)
+    for columns in score_cohort(chunks, include_contributions):
+        if summary is not None:
+            summary.update(columns['prs'])
+        if preview is not None:
+            preview.update(columns['sample_id'], columns['prs'])
+        yield columns_to_record_batch(columns, schema)
+    if preview is not None:
+        preview.finish()
+
+def write_results_parquet(chunks, path, include_contributions=False, compression='zstd', summary=None,
+                          preview=None):
+    """逐块评分并增量写入Parquet，每块完成即写出一个row group，返回写入的行数"""
+    pa = _require_pyarrow()
+    schema = get_result_schema(include_contributions)
+    n_rows = 0
+    with pa.parquet.ParquetWriter(path, schema, compression=compression) as writer:
+        for batch in iter_record_batches(chunks, include_contributions, summary, preview):
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    return n_rows
+
+# ---------------------------------------------------------------------------
+# 渐进预览：全量评分进行中即发布逐步细化的分布快照（直方图、分位数及误差范围），
+# 最后一次发布的是全部记录的精确结果
+# ---------------------------------------------------------------------------
+
+PREVIEW_BINS = 60
+
+class ProgressivePreview:
+    """
+    评分过程中维护已评分记录的直方图和蓄水池样本，每every块发布一次快照；
+    快照保存在latest中（整体替换，可从其他线程直接读取），给定callback时同时传给它
+    """
+
+    def __init__(self, callback=None, every=4, total=None, reservoir_size=10_000, n_bins=PREVIEW_BINS, rng=0):
+        self.callback = callback
+        self.every = every
+        self.total = total
+        self.histogram = ScoreHistogram(n_bins=n_bins)
+        self.density_histogram = ScoreHistogram(n_bins=DENSITY_GRID_SIZE)
+        self.reservoir = ScoreReservoir(reservoir_size, rng)
+        self.n_chunks = 0
+        self.latest = None
+        self.done = False
+        self.error = None
+
+    def update(self, sample_ids, prs):
+        self.histogram.update(prs)
+        self.density_histogram.update(prs)
+        self.reservoir.update(prs, sample_ids)
+        self.n_chunks += 1
+        if self.n_chunks % self.every == 0:
+            self.publish()
+
+    def finish(self):
+        self.total = self.reservoir.count
+        self.publish()
+        self.done = True
+
+    def publish(self):
+        self.latest = describe_partial_distribution(self.histogram, self.reservoir, self.total,
+                                                    density_histogram=self.density_histogram)
+        if self.callback is not None:
+            self.callback(self.latest)
+
+def run_preview(chunks, preview):
+    """只评分不保存结果，逐块更新preview；出错时记录在preview.error中"""
+    try:
+        for sample_ids, dosages in chunks:
+            prs, _, _ = calculate_prs_imputed(dosages)
+            preview.update(sample_ids, prs)
+        preview.finish()
+    except Exception as e:
+        preview.error = e
+        preview.done = True
+    return preview
+
+def start_background_preview(chunks, total=None, every=2, **kwargs):
+    """在后台守护线程中运行run_preview，立即返回可轮询latest/done的ProgressivePreview"""
+    preview = ProgressivePreview(every=every, total=total, **kwargs)
+    threading.Thread(target=run_preview, args=(chunks, preview), daemon=True).start()
+    return preview
+
+def write_preview_snapshot(path):
+    """返回把快照原子写入JSON文件的回调，读取方不会看到写了一半的文件"""
+    def callback(snapshot):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(temp_path, path)
+    return callback
+
+def _summarize_chunk(chunk_index, dosages):
+    # 每块使用由块编号确定的随机流，合并结果与进程数无关
+    prs, _, _ = calculate_prs_imputed(dosages)
+    return ScoreSummary(rng=chunk_index).update(prs)
+
+def summarize_cohort(chunks, workers=1):
+    """
+    map-reduce方式汇总队列的得分分布：每块（可在工作进程中）生成一个ScoreSummary，再按顺序合并
+    """
+    summary = ScoreSummary(rng=0)
+    tasks = ((k, dosages) for k, (_, dosages) in enumerate(chunks))
+    for chunk_summary in bounded_ordered_map(_summarize_chunk, tasks, workers):
+        summary.merge(chunk_summary)
+    return summary
+
+def merge_summary_files(paths):
+    """合并多次运行分别保存的汇总JSON"""
+    summary = None
+    for path in paths:
+        with open(path) as f:
+            part = ScoreSummary.from_dict(json.load(f), rng=0)
+        summary = part if summary is None else summary.merge(part)
+    return summary
+
+def write_summary(summary, path):
+    with open(path, 'w') as f:
+        json.dump(summary.to_dict(), f)
+    description = summary.describe()
+    print(f"Summary of {description['count']:,} scores: mean {description['mean']:.4f}, "
+          f"SD {description['std']:.4f}, median {description['quantiles']['0.5']:.4f} -> {path}")
+
+def results_to_pandas(batches):
+    """将RecordBatch转为pandas DataFrame，数值列按块直接引用Arrow缓冲区"""
+    pa = _require_pyarrow()
+    table = pa.Table.from_batches(list(batches))
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+def benchmark_export(n_samples, chunk_size=100_000, include_contributions=False, path=None, seed=None):
+    """端到端导出基准：模拟队列 -> 评分 -> Arrow -> Parquet -> pandas"""
+    pa = _require_pyarrow()
+    dosages = simulate_cohort_dosages(n_samples, seed)
+    sample_ids = np.array([f"SIM{i:08d}" for i in range(n_samples)], dtype=object)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        output_path = path or os.path.join(tmpdir, 'results.parquet')
+
+        start = time.perf_counter()
+        n_rows = write_results_parquet(
+            iter_cohort_chunks(sample_ids, dosages, chunk_size), output_path, include_contributions
+        )
+        export_time = time.perf_counter() - start
+        file_size = os.path.getsize(output_path)
+
+        start = time.perf_counter()
+        frame = results_to_pandas(pa.parquet.read_table(output_path).to_batches())
+        read_time = time.perf_counter() - start
+
+    return {
+        'samples': n_rows,
+        'columns': frame.shape[1],
+        'export_seconds': export_time,
+        'export_rows_per_second': n_rows / export_time,
+        'parquet_bytes': file_size,
+        'read_to_pandas_seconds': read_time
+    }
+
+# ---------------------------------------------------------------------------
+# 流式评分：逐块读取输入、评分并立即写出，内存中只保留有限的几块
+# ---------------------------------------------------------------------------
+
+OUTPUT_COLUMNS = ('sample_id', 'prs', 'percentile', 'risk_tier', 'percentile_band', 'call_rate', 'high_missingness',
+                  'het_rate', 'het_outlier', 'effect_allele_count', 'effect_allele_outlier',
+                  'effect_snps', 'risk_snps', 'protective_snps')
+
+_COLUMN_FORMATTERS = {
+    'sample_id': str,
+    'prs': '{:.4f}'.format,
+    'percentile': '{:.2f}'.format,
+    'risk_tier': lambda code: get_category(code, RISK_TIERS)['level'],
+    'percentile_band': lambda code: get_category(code, PERCENTILE_BANDS)['level'],
+    'call_rate': '{:.3f}'.format,
+    'high_missingness': lambda flagged: '1' if flagged else '0',
+    'het_rate': '{:.3f}'.format,
+    'het_outlier': lambda flagged: '1' if flagged else '0',
+    'effect_allele_count': str,
+    'effect_allele_outlier': lambda flagged: '1' if flagged else '0',
+    'effect_snps': str,
+    'risk_snps': str,
+    'protective_snps': str
+}
+
+def format_result_lines(columns, output_columns=OUTPUT_COLUMNS):
+    """将结果列格式化为TSV文本行"""
+    formatted = [[_COLUMN_FORMATTERS[name](value) for value in columns[name].tolist()]
+                 for name in output_columns]
+    return ''.join('\t'.join(row) + '\n' for row in zip(*formatted))
+
+def bounded_ordered_map(func, tasks, workers=1):
+    """
+    有界并行映射：最多保留2*workers个在途任务，按输入顺序产出结果
+    workers<=1时在当前进程内顺序执行
+    """
+    if workers <= 1:
+        for args in tasks:
+            yield func(*args)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for args in tasks:
+            pending.append(executor.submit(func, *args))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _score_tsv_lines(header, lines, output_columns):
+    sample_ids, dosages = tsv_lines_to_dosages(header, lines)
+    return format_result_lines(score_chunk(sample_ids, dosages), output_columns)
+
+def _score_consumer_lines(sample_id, lines, output_columns):
+    dosages = read_consumer_dosages(lines)
+    return format_result_lines(score_chunk([sample_id], dosages[np.newaxis, :]), output_columns)
+
+def _score_consumer_file(path, output_columns):
+    with open_input(path) as stream:
+        return _score_consumer_lines(_sample_id_from_path(path), stream, output_columns)
+
+def _sample_id_from_path(path):
+    name = os.path.basename(path)
+    for suffix in ('.gz', '.txt', '.tsv', '.csv'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    return name
+
+def open_input(source):
+    """打开输入源：'-'为标准输入，.gz文件自动解压"""
+    if source == '-':
+        return contextlib.nullcontext(sys.stdin)
+    if source.endswith('.gz'):
+        return gzip.open(source, 'rt')
+    return open(source)
+
+def _stream_tsv(lines, out, chunk_size, workers, output_columns):
+    header = next(lines, '').rstrip('\r\n').split('\t')
+    if header == ['']:
+        return
+    tasks = ((header, chunk, output_columns) for chunk in iter_line_chunks(lines, chunk_size))
+    with contextlib.closing(bounded_ordered_map(_score_tsv_lines, tasks, workers)) as results:
+        for text in results:
+            out.write(text)
+            out.flush()
+
+def _stream_vcf(lines, out, chunk_size, workers, output_columns, build):
+    sample_ids, lines = parse_vcf_header(lines)
+    index = build_coordinate_index(build)
+    dosages = np.full((len(sample_ids), len(SNP_IDS)), MISSING_DOSAGE, dtype=np.int8)
+    found = np.zeros(len(SNP_IDS), dtype=bool)
+
+    # VCF按位点排列，每个样本的分数需要看到全部模型变异后才能确定；
+    # 只保留(样本数 × 模型变异数)的剂量矩阵，不缓存原始行
+    tasks = ((chunk, index) for chunk in iter_line_chunks(lines, chunk_size))
+    with contextlib.closing(bounded_ordered_map(vcf_lines_to_model_dosages, tasks, workers)) as results:
+        for model_index, effect_dosages in results:
+            if model_index.size:
+                dosages[:, model_index] = effect_dosages.T
+                found[model_index] = True
+            if found.all():
+                # 所有模型变异都已找到，无需读取剩余输入
+                break
+
+    for chunk_ids, chunk_dosages in iter_cohort_chunks(sample_ids, dosages, chunk_size):
+        out.write(format_result_lines(score_chunk(chunk_ids, chunk_dosages), output_columns))
+        out.flush()
+
+def stream_scores(sources, out, input_format=None, chunk_size=10_000, workers=1,
+                  output_columns=OUTPUT_COLUMNS, build='GRCh37'):
+    """
+    流式评分多个输入源并将结果以TSV写到out
+    TSV宽表每读完一块即输出；23andMe文件每个文件一个样本，可跨文件并行；
+    VCF在所有模型变异出现后（或读到末尾时）输出全部样本
+    """
+    out.write('\t'.join(output_columns) + '\n')
+    out.flush()
+
+    consumer_files = []
+
+    def flush_consumer_files():
+        tasks = ((path, output_columns) for path in consumer_files)
+        for text in bounded_ordered_map(_score_consumer_file, tasks, workers):
+            out.write(text)
+            out.flush()
+        consumer_files.clear()
+
+    for source in sources:
+        source_format = input_format
+        if source != '-' and source_format is None:
+            with open_input(source) as stream:
+                source_format, _ = peek_format(stream)
+        if source_format == '23andme' and source != '-':
+            consumer_files.append(source)
+            continue
+        flush_consumer_files()
+
+        with open_input(source) as stream:
+            lines = iter(stream)
+            if source_format is None:
+                source_format, lines = peek_format(lines)
+            if source_format == 'tsv':
+                _stream_tsv(lines, out, chunk_size, workers, output_columns)
+            elif source_format == 'vcf':
+                _stream_vcf(lines, out, chunk_size, workers, output_columns, build)
+            else:
+                out.write(_score_consumer_lines('stdin', lines, output_columns))
+                out.flush()
+
+    flush_consumer_files()
+
+def main():
+    parser = argparse.ArgumentParser(description="Score a cohort and export results to Parquet")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--cohort', help="Wide cohort table (sample ID column + one column per rsid)")
+    source.add_argument('--simulate', type=int, metavar='N', help="Benchmark export with N simulated samples")
+    source.add_argument('--merge', nargs='+', metavar='SUMMARY', help="Merge summary JSON files into --summary")
+    parser.add_argument('--output', help="Parquet output path")
+    parser.add_argument('--chunk-size', type=int, default=100_000)
+    parser.add_argument('--contributions', action='store_true', help="Include per-variant contribution columns")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--summary', help="Write mergeable score-distribution summary (JSON) to this path")
+    parser.add_argument('--workers', type=int, default=1, help="Worker processes for summary-only runs")
+    parser.add_argument('--preview', help="Keep a progressively refined distribution snapshot (JSON) at this path")
+    parser.add_argument('--preview-every', type=int, default=4, help="Chunks between preview snapshots")
+    args = parser.parse_args()
+
+    if args.merge:
+        if not args.summary:
+            parser.error("--summary is required with --merge")
+        write_summary(merge_summary_files(args.merge), args.summary)
+        return
+
+    if args.simulate and args.summary and not args.output:
+        chunks = iter_cohort_chunks(np.arange(args.simulate), simulate_cohort_dosages(args.simulate, args.seed),
+                                    args.chunk_size)
+        write_summary(summarize_cohort(chunks, args.workers), args.summary)
+        return
+
+    if args.simulate:
+        result = benchmark_export(args.simulate, args.chunk_size, args.contributions, args.output, args.seed)
+        print(f"Exported {result['samples']:,} samples x {result['columns']} columns in "
+              f"{result['export_seconds']:.2f} s ({result['export_rows_per_second']:,.0f} rows/s, "
+              f"{result['parquet_bytes'] / 2**20:.1f} MB); read back to pandas in "
+              f"{result['read_to_pandas_seconds']:.2f} s")
+        return
+
+    if not args.output and not args.summary:
+        parser.error("--output or --summary is required with --cohort")
+    from genotype_io import read_cohort_table
+    sample_ids, dosages = read_cohort_table(args.cohort)
+    if not args.output:
+        write_summary(summarize_cohort(iter_cohort_chunks(sample_ids, dosages, args.chunk_size), args.workers),
+                      args.summary)
+        return
+    start = time.perf_counter()
+    summary = ScoreSummary(rng=0) if args.summary else None
+    preview = None
+    if args.preview:
+        preview = ProgressivePreview(write_preview_snapshot(args.preview), args.preview_every, len(sample_ids))
+    n_rows = write_results_parquet(
+        iter_cohort_chunks(sample_ids, dosages, args.chunk_size), args.output, args.contributions,
+        summary=summary, preview=preview
+    )
+    print(f"Wrote {n_rows:,} results to {args.output} in {time.perf_counter() - start:.2f} s")
+    if summary is not None:
+        write_summary(summary, args.summary)
+
+if __name__ == "__main__":
+    main()
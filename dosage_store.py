@@ -0,0 +1,294 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from prs_core import (
+    SNP_DATA,
+    SNP_IDS,
+    CompactDosages,
+    SparseDosages,
+    calculate_model_scores,
+    choose_dosage_layout,
+    get_effect_weights,
+    simulate_cohort_dosages
+)
+
+# 持久化剂量存储：每个队列一个目录，模型变异的int8剂量按行（样本）连续存放在dosages.int8中，
+# 通过内存映射读取；改动权重后重新评分只需对映射矩阵做一次矩阵-向量乘法，无需重读原始基因型文件。
+# store.json记录变异集合的版本戳和已提交的样本数，追加样本时只在文件末尾写入，不重写已有数据。
+# 首次追加时按实测密度选择布局；罕见变异为主（sparse）的存储在追加时同时写入非零剂量的CSR副本
+# （每行非零数、列号、剂量，缺失位置另存），评分直接映射CSR文件，无需每次从稠密矩阵重建
+
+STORE_FORMAT = 1
+_METADATA_FILE = 'store.json'
+_DOSAGE_FILE = 'dosages.int8'
+_SAMPLE_FILE = 'samples.txt'
+# CSR副本：(部分, 文件, 数据类型)；matrix只含1/2剂量，missing只含缺失位置（无数据文件）
+_SPARSE_FILES = (
+    ('matrix', 'counts', 'sparse_counts.int32', np.int32),
+    ('matrix', 'indices', 'sparse_indices.int32', np.int32),
+    ('matrix', 'data', 'sparse_data.int8', np.int8),
+    ('missing', 'counts', 'missing_counts.int32', np.int32),
+    ('missing', 'indices', 'missing_indices.int32', np.int32)
+)
+
+def get_variant_set_version(variant_ids=SNP_IDS):
+    """变异集合的版本戳：由有序的rsid和效应/非效应等位基因计算"""
+    digest = hashlib.sha256()
+    for rsid in variant_ids:
+        snp_info = SNP_DATA.get(rsid, {})
+        digest.update(f"{rsid}:{snp_info.get('effect_allele', '')}:{snp_info.get('other_allele', '')}\n".encode())
+    return digest.hexdigest()[:16]
+
+class DosageStore:
+    """单个队列的内存映射剂量存储"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, _METADATA_FILE)) as f:
+            self.metadata = json.load(f)
+        if self.metadata.get('format') != STORE_FORMAT:
+            raise ValueError(f"Unsupported dosage store format in {path}: {self.metadata.get('format')}")
+        self.variant_ids = tuple(self.metadata['variant_ids'])
+        self._dosages = None
+        self._compact = None
+        self._sample_ids = None
+
+    @classmethod
+    def create(cls, path, variant_ids=SNP_IDS):
+        """创建空存储；目录已存在存储时报错"""
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, _METADATA_FILE)):
+            raise FileExistsError(f"Dosage store already exists: {path}")
+        for name in (_DOSAGE_FILE, _SAMPLE_FILE):
+            open(os.path.join(path, name), 'wb').close()
+        metadata = {
+            'format': STORE_FORMAT,
+            'variant_ids': list(variant_ids),
+            'variant_set_version': get_variant_set_version(variant_ids),
+            'n_samples': 0,
+            'sample_bytes': 0,
+            'layout': None,
+            'sparse_nnz': 0,
+            'missing_nnz': 0
+        }
+        _write_metadata(path, metadata)
+        return cls(path)
+
+    @classmethod
+    def open_or_create(cls, path, variant_ids=SNP_IDS):
+        if os.path.exists(os.path.join(path, _METADATA_FILE)):
+            return cls(path)
+        return cls.create(path, variant_ids)
+
+    @property
+    def n_samples(self):
+        return self.metadata['n_samples']
+
+    @property
+    def layout(self):
+        """'sparse'或'dense'；首次追加前为None，早期创建的存储没有此字段，视为dense"""
+        return self.metadata.get('layout', 'dense')
+
+    @property
+    def version(self):
+        return self.metadata['variant_set_version']
+
+    def is_current(self):
+        """存储覆盖的变异集合是否与当前模型一致"""
+        return self.variant_ids == SNP_IDS and self.version == get_variant_set_version(SNP_IDS)
+
+    @property
+    def dosages(self):
+        """只读内存映射的(样本数, 变异数)剂量矩阵"""
+        if self._dosages is None:
+            if self.n_samples == 0:
+                self._dosages = np.empty((0, len(self.variant_ids)), dtype=np.int8)
+            else:
+                self._dosages = np.memmap(os.path.join(self.path, _DOSAGE_FILE), dtype=np.int8, mode='r',
+                                          shape=(self.n_samples, len(self.variant_ids)))
+        return self._dosages
+
+    @property
+    def compact(self):
+        """
+        评分用的剂量布局：sparse存储直接映射持久化的CSR副本，否则使用内存映射矩阵（不打包，避免复制）；
+        两者都不需要在打开存储时扫描或转换剂量
+        """
+        if self._compact is None:
+            if self.layout == 'sparse':
+                self._compact = CompactDosages(self._map_sparse())
+            else:
+                self._compact = CompactDosages(self.dosages, 'dense')
+        return self._compact
+
+    def _map_sparse(self):
+        from scipy.sparse import csr_array
+        n_samples, n_variants = self.n_samples, len(self.variant_ids)
+        lengths = {'counts': n_samples, 'matrix': self.metadata['sparse_nnz'],
+                   'missing': self.metadata['missing_nnz']}
+        arrays = {}
+        for part, field, name, dtype in _SPARSE_FILES:
+            count = lengths['counts' if field == 'counts' else part]
+            arrays[part, field] = (np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=(count,))
+                                   if count else np.empty(0, dtype=dtype))
+
+        def build(part, data):
+            indptr = np.zeros(n_samples + 1, dtype=np.int64)
+            np.cumsum(arrays[part, 'counts'], out=indptr[1:])
+            if indptr[-1] < np.iinfo(np.int32).max:
+                indptr = indptr.astype(np.int32)
+            return csr_array((data, arrays[part, 'indices'], indptr), shape=(n_samples, n_variants))
+
+        missing_data = np.ones(len(arrays['missing', 'indices']), dtype=bool)
+        return SparseDosages(build('matrix', arrays['matrix', 'data']), build('missing', missing_data))
+
+    @property
+    def sample_ids(self):
+        if self._sample_ids is None:
+            with open(os.path.join(self.path, _SAMPLE_FILE), 'rb') as f:
+                data = f.read(self.metadata['sample_bytes'])
+            self._sample_ids = data.decode().splitlines()
+        return self._sample_ids
+
+    def append(self, sample_ids, dosages):
+        """
+        在末尾追加样本：先写剂量、样本ID（sparse存储还有CSR副本），最后更新store.json作为提交点；
+        上次追加中断留下的未提交尾部会被截断覆盖
+        """
+        dosages = np.ascontiguousarray(dosages, dtype=np.int8)
+        if dosages.ndim != 2 or dosages.shape[1] != len(self.variant_ids):
+            raise ValueError(f"Expected dosages with {len(self.variant_ids)} columns, got shape {dosages.shape}")
+        if len(sample_ids) != len(dosages):
+            raise ValueError(f"{len(sample_ids)} sample IDs for {len(dosages)} dosage rows")
+
+        metadata = dict(self.metadata)
+        if metadata.get('layout') is None:
+            # 布局在首次追加时按该批样本的密度确定，之后不再改变
+            metadata['layout'] = (choose_dosage_layout(dosages, allow_packed=False)
+                                  if self.n_samples == 0 and len(dosages) else self.layout)
+
+        ids_text = ''.join(f"{sample_id}\n" for sample_id in sample_ids).encode()
+        _append_file(self.path, _DOSAGE_FILE, self.n_samples * len(self.variant_ids), dosages.tobytes())
+        _append_file(self.path, _SAMPLE_FILE, self.metadata['sample_bytes'], ids_text)
+
+        if metadata['layout'] == 'sparse':
+            sparse = SparseDosages.from_dense(dosages)
+            committed = {'counts': self.n_samples, 'matrix': self.metadata.get('sparse_nnz', 0),
+                         'missing': self.metadata.get('missing_nnz', 0)}
+            for part, field, name, dtype in _SPARSE_FILES:
+                matrix = getattr(sparse, part)
+                values = {'counts': np.diff(matrix.indptr), 'indices': matrix.indices, 'data': matrix.data}[field]
+                count = committed['counts' if field == 'counts' else part]
+                _append_file(self.path, name, count * np.dtype(dtype).itemsize,
+                             np.ascontiguousarray(values, dtype=dtype).tobytes())
+            metadata['sparse_nnz'] = committed['matrix'] + sparse.matrix.nnz
+            metadata['missing_nnz'] = committed['missing'] + sparse.missing.nnz
+
+        metadata['n_samples'] += len(dosages)
+        metadata['sample_bytes'] += len(ids_text)
+        _write_metadata(self.path, metadata)
+        self.metadata = metadata
+        self._dosages = None
+        self._compact = None
+        self._sample_ids = None
+        return self.n_samples
+
+    def score(self, weights=None):
+        """用给定权重（默认当前模型权重）对全部样本重新评分"""
+        if weights is None:
+            self._check_current()
+            weights = get_effect_weights()
+        weights = np.asarray(weights, dtype=np.float64)
+        if weights.shape != (len(self.variant_ids),):
+            raise ValueError(f"Expected {len(self.variant_ids)} weights, got {weights.shape}")
+        return self.compact.score(weights)
+
+    def score_models(self, model_ids=None):
+        """对全部样本计算注册表中各模型的得分，返回(模型ID元组, 得分矩阵)"""
+        self._check_current()
+        return calculate_model_scores(self.dosages, model_ids)
+
+    def _check_current(self):
+        if not self.is_current():
+            raise ValueError(f"Dosage store {self.path} covers variant set {self.version}, "
+                             f"but the current model is {get_variant_set_version(SNP_IDS)}")
+
+def _append_file(path, name, committed_bytes, payload):
+    # 先截断到已提交的长度（丢弃中断留下的尾部）再追加；文件不存在时创建
+    with open(os.path.join(path, name), 'ab') as f:
+        f.truncate(committed_bytes)
+        f.write(payload)
+
+def _write_metadata(path, metadata):
+    # 先写临时文件再原子替换，读取方不会看到写了一半的元数据
+    temp_path = os.path.join(path, _METADATA_FILE + '.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(metadata, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, os.path.join(path, _METADATA_FILE))
+
+def read_weights_table(path, variant_ids=SNP_IDS):
+    """读取rsid<TAB>权重的表格，按variant_ids排列；未列出的变异沿用当前模型权重"""
+    weights = dict(zip(SNP_IDS, get_effect_weights()))
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) < 2 or fields[0].startswith('#'):
+                continue
+            try:
+                weights[fields[0]] = float(fields[1])
+            except ValueError:
+                continue  # 表头
+    return np.array([weights.get(rsid, 0.0) for rsid in variant_ids])
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory-mapped cohort dosage store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    append_parser = subparsers.add_parser('append', help="Append samples (creates the store if needed)")
+    append_parser.add_argument('store')
+    source = append_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--cohort', help="Wide cohort table (sample ID column + one column per rsid)")
+    source.add_argument('--simulate', type=int, metavar='N', help="Append N simulated samples")
+    append_parser.add_argument('--seed', type=int, default=None)
+
+    score_parser = subparsers.add_parser('score', help="Re-score every stored sample")
+    score_parser.add_argument('store')
+    score_parser.add_argument('--weights', help="TSV of rsid and effect weight overriding the model weights")
+    score_parser.add_argument('--output', help="Write sample_id and prs as TSV")
+
+    args = parser.parse_args()
+
+    if args.command == 'append':
+        store = DosageStore.open_or_create(args.store)
+        if args.cohort:
+            from genotype_io import read_cohort_table
+            sample_ids, dosages = read_cohort_table(args.cohort)
+        else:
+            dosages = simulate_cohort_dosages(args.simulate, args.seed)
+            sample_ids = [f"SIM{store.n_samples + i:07d}" for i in range(args.simulate)]
+        start = time.perf_counter()
+        total = store.append(sample_ids, dosages)
+        print(f"Appended {len(sample_ids):,} samples in {time.perf_counter() - start:.2f} s "
+              f"({total:,} total, variant set {store.version})")
+        return
+
+    store = DosageStore(args.store)
+    weights = read_weights_table(args.weights, store.variant_ids) if args.weights else None
+    start = time.perf_counter()
+    prs = store.score(weights)
+    print(f"Scored {len(prs):,} samples in {time.perf_counter() - start:.3f} s "
+          f"(mean PRS {prs.mean():.4f})" if len(prs) else "Store is empty")
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write('sample_id\tprs\n')
+            f.writelines(f"{sample_id}\t{score:.4f}\n" for sample_id, score in zip(store.sample_ids, prs.tolist()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import io
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from prs_core import SNP_DATA, SNP_IDS, MISSING_DOSAGE
+
+def get_dosage_lookup(snp_info):
+    """构建基因型字符串/剂量文本到效应等位基因剂量的查找表"""
+    effect_allele = snp_info['effect_allele']
+    other_allele = snp_info['other_allele']
+    return {
+        '0': 0, '1': 1, '2': 2,
+        other_allele + other_allele: 0,
+        effect_allele + other_allele: 1,
+        other_allele + effect_allele: 1,
+        effect_allele + effect_allele: 2
+    }
+
+def table_to_dosages(table, sample_column=None):
+    """
+    将宽格式DataFrame（每行一个样本，每列一个rsid）转换为(样本ID列表, 按SNP_IDS排列的int8剂量矩阵)
+    """
+    sample_column = sample_column or table.columns[0]
+    sample_ids = table[sample_column].tolist()
+
+    dosages = np.full((len(table), len(SNP_IDS)), MISSING_DOSAGE, dtype=np.int8)
+    for j, rsid in enumerate(SNP_IDS):
+        if rsid not in table.columns:
+            continue
+        column = table[rsid].fillna('').str.strip().str.upper()
+        mapped = column.map(get_dosage_lookup(SNP_DATA[rsid]))
+        dosages[:, j] = mapped.fillna(MISSING_DOSAGE).to_numpy(dtype=np.int8)
+
+    return sample_ids, dosages
+
+def read_cohort_table(path, sample_column=None):
+    """
+    读取宽格式队列表：每行一个样本，每列一个rsid，值为基因型（如AG）或剂量（0/1/2）
+    返回(样本ID列表, 按SNP_IDS排列的int8剂量矩阵)
+    """
+    sep = ',' if str(path).endswith('.csv') else '\t'
+    table = pd.read_csv(path, sep=sep, dtype=str)
+    return table_to_dosages(table, sample_column)
+
+def iter_cohort_table_chunks(source, chunk_size=10_000, sep='\t', sample_column=None):
+    """逐块读取宽格式队列表（路径或文件对象），每块生成(样本ID列表, int8剂量矩阵)"""
+    for table in pd.read_csv(source, sep=sep, dtype=str, chunksize=chunk_size):
+        yield table_to_dosages(table, sample_column)
+
+# 各基因组版本在SNP_DATA中对应的位置字段
+GENOME_BUILDS = {
+    'GRCh37': 'position',
+    'GRCh38': 'position_grch38'
+}
+
+_SEX_CHROMOSOME_CODES = {'X': 23, 'Y': 24, 'XY': 25, 'M': 26, 'MT': 26}
+
+def _chromosome_code(chrom):
+    name = str(chrom).upper()
+    if name.startswith('CHR'):
+        name = name[3:]
+    if name.isdigit():
+        return int(name)
+    return _SEX_CHROMOSOME_CODES.get(name, 0)
+
+def encode_coordinates(chroms, positions):
+    """将(染色体, 位置)编码为可排序的int64键：染色体编号占高32位"""
+    chroms = np.asarray(chroms)
+    if chroms.dtype.kind in 'iu':
+        codes = chroms.astype(np.int64)
+    else:
+        # 染色体名称种类很少，只对唯一值做一次解析
+        inverse, unique = pd.factorize(chroms.ravel())
+        codes = np.array([_chromosome_code(c) for c in unique], dtype=np.int64)[inverse].reshape(chroms.shape)
+    return (codes << 32) | np.asarray(positions, dtype=np.int64)
+
+def build_coordinate_index(build='GRCh37'):
+    """构建按坐标排序的模型变异索引，用于二分查找匹配"""
+    if build not in GENOME_BUILDS:
+        raise ValueError(f"Unknown genome build {build!r}, expected one of {sorted(GENOME_BUILDS)}")
+    position_field = GENOME_BUILDS[build]
+    keys = encode_coordinates(
+        [SNP_DATA[rsid]['chromosome'] for rsid in SNP_IDS],
+        [SNP_DATA[rsid][position_field] for rsid in SNP_IDS]
+    )
+    order = np.argsort(keys, kind='stable')
+    return {
+        'build': build,
+        'keys': keys[order],
+        'model_index': order,
+        'effect_allele': np.array([SNP_DATA[SNP_IDS[i]]['effect_allele'] for i in order]),
+        'other_allele': np.array([SNP_DATA[SNP_IDS[i]]['other_allele'] for i in order])
+    }
+
+def check_harmonized_positions(path, build='GRCh38'):
+    """
+    将SNP_DATA中指定版本的坐标与PGS Catalog协调评分文件（如PGS000334_hmPOS_GRCh38.txt.gz）核对，
+    返回[(rsid, 模型中的(染色体, 位置), 文件中的(染色体, 位置))]；文件中缺失的rsid对应None
+    """
+    if build not in GENOME_BUILDS:
+        raise ValueError(f"Unknown genome build {build!r}, expected one of {sorted(GENOME_BUILDS)}")
+    table = pd.read_csv(path, sep='\t', comment='#', dtype=str)
+    missing_columns = {'hm_chr', 'hm_pos'} - set(table.columns)
+    if missing_columns:
+        raise ValueError(f"Not a harmonized PGS Catalog scoring file, missing columns: {sorted(missing_columns)}")
+    rsids = table['hm_rsID'].fillna(table['rsID']) if 'hm_rsID' in table.columns else table['rsID']
+    harmonized = {
+        rsid: (chrom, int(pos))
+        for rsid, chrom, pos in zip(rsids, table['hm_chr'], table['hm_pos'])
+        if isinstance(pos, str) and pos.isdigit()
+    }
+
+    mismatches = []
+    for rsid in SNP_IDS:
+        snp_info = SNP_DATA[rsid]
+        expected = (snp_info['chromosome'], snp_info[GENOME_BUILDS[build]])
+        found = harmonized.get(rsid)
+        if found is None or _chromosome_code(found[0]) != _chromosome_code(expected[0]) or found[1] != expected[1]:
+            mismatches.append((rsid, expected, found))
+    return mismatches
+
+def match_variants_by_position(chroms, positions, ref_alleles, alt_alleles, build='GRCh37', index=None):
+    """
+    按(染色体, 位置, 等位基因)将输入位点匹配到模型变异
+    返回(model_index, alt_is_effect)：未匹配的位点model_index为-1；
+    alt_is_effect为False表示输入的ALT是非效应等位基因、REF是效应等位基因
+    """
+    if index is None:
+        index = build_coordinate_index(build)
+    keys = encode_coordinates(chroms, positions)
+    ref_alleles = np.asarray(ref_alleles, dtype=str)
+    alt_alleles = np.asarray(alt_alleles, dtype=str)
+
+    # 对全部输入位点一次性二分查找，得到每个位点在模型中的候选区间
+    lo = np.searchsorted(index['keys'], keys, side='left')
+    hi = np.searchsorted(index['keys'], keys, side='right')
+
+    model_index = np.full(keys.shape, -1, dtype=np.int64)
+    alt_is_effect = np.zeros(keys.shape, dtype=bool)
+
+    # 同一坐标上可能有多个模型变异（多等位位点），逐个候选检查等位基因
+    max_candidates = int((hi - lo).max()) if keys.size else 0
+    for offset in range(max_candidates):
+        candidate = lo + offset
+        pending = np.flatnonzero((candidate < hi) & (model_index < 0))
+        if pending.size == 0:
+            break
+        sorted_pos = candidate[pending]
+        effect = index['effect_allele'][sorted_pos]
+        other = index['other_allele'][sorted_pos]
+        # 只对坐标命中的少量位点做等位基因比较
+        ref = np.char.upper(ref_alleles[pending])
+        alt = np.char.upper(alt_alleles[pending])
+
+        forward = (alt == effect) & (ref == other)
+        reverse = (ref == effect) & (alt == other)
+        matched = forward | reverse
+        model_index[pending[matched]] = index['model_index'][sorted_pos[matched]]
+        alt_is_effect[pending[matched]] = forward[matched]
+
+    return model_index, alt_is_effect
+
+# ---------------------------------------------------------------------------
+# 流式读取：TSV宽表、VCF、23andMe/AncestryDNA原始数据
+# ---------------------------------------------------------------------------
+
+INPUT_FORMATS = ('tsv', 'vcf', '23andme')
+
+def detect_format(first_line):
+    """根据首行判断输入格式"""
+    if first_line.startswith('##fileformat=VCF'):
+        return 'vcf'
+    if first_line.startswith('#') or first_line.split('\t', 1)[0].strip().lower() == 'rsid':
+        return '23andme'
+    return 'tsv'
+
+def peek_format(lines):
+    """读取首行判断格式，返回(格式, 包含首行的完整行迭代器)"""
+    lines = iter(lines)
+    first_line = next(lines, '')
+    return detect_format(first_line), itertools.chain([first_line], lines)
+
+def iter_line_chunks(lines, chunk_size):
+    """将行迭代器按chunk_size行分块，内存中最多只保留一块"""
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+def tsv_lines_to_dosages(header, lines):
+    """解析一块宽格式TSV数据行（不含表头）"""
+    table = pd.read_csv(io.StringIO(''.join(lines)), sep='\t', header=None,
+                        names=header, dtype=str)
+    return table_to_dosages(table, header[0])
+
+class _ConsumerGenotypeParser:
+    """
+    23andMe/AncestryDNA/MyHeritage原始数据的逐行解析核心，命令行的read_consumer_dosages和
+    网页上传的read_consumer_bytes共用；同一rsid出现多次时以最后一行为准
+    """
+
+    def __init__(self):
+        self.model_index = {rsid: i for i, rsid in enumerate(SNP_IDS)}
+        self.lookups = [get_dosage_lookup(SNP_DATA[rsid]) for rsid in SNP_IDS]
+        self.dosages = np.full(len(SNP_IDS), MISSING_DOSAGE, dtype=np.int8)
+        # 按rsid记录是否已出现：首行为未检出（--）或无法解析的rsid也算已出现，重复行不会重复计数
+        self.seen = np.zeros(len(SNP_IDS), dtype=bool)
+        self.remaining = len(SNP_IDS)
+        self.sep = None
+
+    def feed(self, lines):
+        """解析一批文本行，所有模型变异都已出现时返回True"""
+        lines = iter(lines)
+        if self.sep is None:
+            for line in lines:
+                if line.strip() and not line.startswith('#'):
+                    # 个别导出格式（如MyHeritage）为带引号的CSV，按第一条数据行判断分隔符
+                    self.sep = '\t' if '\t' in line else ','
+                    lines = itertools.chain([line], lines)
+                    break
+        sep = self.sep
+        model_index = self.model_index
+        # 注释行和其他rsid在首字段查找时即被跳过，只有模型rsid的行才完整拆分
+        for line in lines:
+            i = model_index.get(line.split(sep, 1)[0].strip('" '))
+            if i is None:
+                continue
+            fields = [field.strip('" \r\n') for field in line.split(sep)]
+            if len(fields) < 4:
+                continue
+            # 23andMe: rsid chrom pos genotype；AncestryDNA: rsid chrom pos allele1 allele2
+            genotype = fields[3] + fields[4] if len(fields) >= 5 else fields[3]
+            self.dosages[i] = self.lookups[i].get(genotype.upper(), MISSING_DOSAGE)
+            if not self.seen[i]:
+                self.seen[i] = True
+                self.remaining -= 1
+                if self.remaining == 0:
+                    return True
+        return False
+
+def read_consumer_dosages(lines):
+    """
+    解析23andMe/AncestryDNA格式的单人原始数据，返回按SNP_IDS排列的剂量数组
+    所有模型变异都找到后立即停止读取
+    """
+    parser = _ConsumerGenotypeParser()
+    parser.feed(lines)
+    return parser.dosages
+
+def read_consumer_bytes(data, chunk_size=1 << 22):
+    """
+    按大块扫描23andMe/AncestryDNA原始数据的字节内容，与read_consumer_dosages使用同一解析核心
+    所有模型变异都找到后立即停止，返回按SNP_IDS排列的剂量数组
+    """
+    parser = _ConsumerGenotypeParser()
+    start = 0
+    while start < len(data):
+        # 块在换行处结束，避免切断行
+        end = data.find(b'\n', start + chunk_size)
+        end = len(data) if end < 0 else end
+        if parser.feed(data[start:end].decode('utf-8', errors='replace').split('\n')):
+            break
+        start = end + 1
+    return parser.dosages
+
+def parse_vcf_header(lines):
+    """读取VCF元信息和表头行，返回(样本ID列表, 剩余数据行迭代器)"""
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith('##'):
+            continue
+        if line.startswith('#CHROM'):
+            return line.rstrip('\r\n').split('\t')[9:], lines
+        raise ValueError("VCF header line (#CHROM ...) not found")
+    raise ValueError("VCF header line (#CHROM ...) not found")
+
+def _gt_allele_count(sample_field, allele_index):
+    """GT中等位基因编号allele_index出现的次数，缺失返回MISSING_DOSAGE"""
+    gt = sample_field.split(':', 1)[0]
+    alleles = gt.replace('|', '/').split('/')
+    if '.' in alleles:
+        return MISSING_DOSAGE
+    return alleles.count(allele_index)
+
+def vcf_lines_to_model_dosages(lines, index):
+    """
+    解析一块VCF数据行：先按坐标和等位基因匹配模型，只对命中的位点解析GT
+    返回(model_index, effect_dosages)，effect_dosages形状为(命中位点数, 样本数)
+    """
+    line_numbers, chroms, positions, refs, alts, allele_indices = [], [], [], [], [], []
+    for n, line in enumerate(lines):
+        chrom, pos, _, ref, alt, _ = line.split('\t', 5)
+        # 多等位位点按每个ALT分别匹配
+        for k, alt_allele in enumerate(alt.split(','), start=1):
+            line_numbers.append(n)
+            chroms.append(chrom)
+            positions.append(int(pos))
+            refs.append(ref)
+            alts.append(alt_allele)
+            allele_indices.append(str(k))
+
+    if not line_numbers:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.int8)
+
+    model_index, alt_is_effect = match_variants_by_position(chroms, positions, refs, alts, index=index)
+    matched = np.flatnonzero(model_index >= 0)
+
+    rows = []
+    for m in matched:
+        sample_fields = lines[line_numbers[m]].rstrip('\r\n').split('\t')[9:]
+        # ALT为效应等位基因时计该ALT的拷贝数；否则REF为效应等位基因，计REF（编号0）的拷贝数。
+        # 多等位位点上不能取2减ALT拷贝数，否则其他ALT也会被当作效应等位基因
+        allele_index = allele_indices[m] if alt_is_effect[m] else '0'
+        rows.append(np.array([_gt_allele_count(field, allele_index) for field in sample_fields], dtype=np.int8))
+
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.int8)
+    return model_index[matched], np.vstack(rows)
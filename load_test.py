@@ -0,0 +1,152 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from streamlit.logger import set_log_level
+from streamlit.testing.v1 import AppTest
+
+from prs_core import SNP_IDS, get_shared_asset_stats
+from process_memory import get_rss_bytes
+
+# 并发会话压测：在同一进程内用多个无头AppTest会话驱动app.main，
+# 与Streamlit服务器用线程承载会话的方式一致
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+def _find_button(at, label):
+    for button in at.button:
+        if label in button.label:
+            return button
+    raise LookupError(f"Button not found: {label}")
+
+class SessionDriver:
+    """驱动单个无头会话执行固定的用户脚本，并记录每次rerun的延迟"""
+
+    def __init__(self, session_id, timeout=60):
+        self.session_id = session_id
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.latencies = []
+
+    def _timed(self, action):
+        start = time.perf_counter()
+        action()
+        self.latencies.append(time.perf_counter() - start)
+        if self.at.exception:
+            raise RuntimeError(f"Session {self.session_id}: {self.at.exception[0].message}")
+
+    def run_script(self, steps):
+        # 首次加载 + 接受免责声明
+        self._timed(self.at.run)
+        self._timed(lambda: _find_button(self.at, "I have read and agree").click().run())
+
+        for step in range(steps):
+            # 在render_snp_dropdown中选择SNP
+            option_index = 1 + (self.session_id + step) % len(SNP_IDS)
+            self._timed(lambda: self.at.selectbox(key="snp_dropdown").select_index(option_index).run())
+
+            # 在编辑器中修改基因型并应用
+            rsid = self.at.session_state.selected_snp
+            editor = self.at.selectbox(key=f"edit_{rsid}")
+            new_genotype = next(option for option in editor.options if option != editor.value)
+            self._timed(lambda: editor.select(new_genotype).run())
+            self._timed(lambda: _find_button(self.at, "Apply Changes").click().run())
+
+            # 全部随机化
+            self._timed(lambda: _find_button(self.at, "Randomize All").click().run())
+
+        return self.latencies
+
+def run_concurrency_level(n_sessions, steps, timeout=60):
+    """以n_sessions个并发会话运行脚本，返回该并发度下的统计结果"""
+    drivers = [SessionDriver(i, timeout) for i in range(n_sessions)]
+    barrier = threading.Barrier(n_sessions)
+
+    def drive(driver):
+        barrier.wait()
+        return driver.run_script(steps)
+
+    rss_before = get_rss_bytes()
+    cpu_before = time.process_time()
+    wall_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+        results = list(executor.map(drive, drivers))
+
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_before
+    # 会话对象仍然存活，RSS增量近似为这些会话占用的内存
+    rss_after = get_rss_bytes()
+
+    latencies = np.concatenate([np.asarray(r) for r in results])
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+
+    return {
+        'sessions': n_sessions,
+        'reruns': int(latencies.size),
+        'wall_time_s': wall_time,
+        'throughput_reruns_per_s': latencies.size / wall_time,
+        'latency_mean_s': float(latencies.mean()),
+        'latency_p50_s': float(p50),
+        'latency_p90_s': float(p90),
+        'latency_p99_s': float(p99),
+        'latency_max_s': float(latencies.max()),
+        'cpu_time_per_session_s': cpu_time / n_sessions,
+        'rss_per_session_bytes': max(0, rss_after - rss_before) / n_sessions,
+    }
+
+def format_report(rows):
+    """将各并发度的结果格式化为吞吐量-并发度表格"""
+    header = (f"{'sessions':>8} {'reruns':>7} {'rerun/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+              f"{'p99 ms':>8} {'max ms':>8} {'cpu/sess s':>10} {'rss/sess MB':>11}")
+    lines = [header, '-' * len(header)]
+    for row in rows:
+        lines.append(
+            f"{row['sessions']:>8} {row['reruns']:>7} {row['throughput_reruns_per_s']:>8.2f} "
+            f"{row['latency_p50_s'] * 1000:>8.1f} {row['latency_p90_s'] * 1000:>8.1f} "
+            f"{row['latency_p99_s'] * 1000:>8.1f} {row['latency_max_s'] * 1000:>8.1f} "
+            f"{row['cpu_time_per_session_s']:>10.2f} {row['rss_per_session_bytes'] / 2**20:>11.2f}"
+        )
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent-session load test for the AD PRS Genome Browser")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="Numbers of simultaneous sessions to test")
+    parser.add_argument('--steps', type=int, default=3,
+                        help="Select/edit/apply/randomize cycles per session")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="Per-rerun timeout in seconds")
+    parser.add_argument('--json', dest='json_path', help="Write results as JSON to this path")
+    args = parser.parse_args()
+
+    # AppTest在裸模式下会为每次rerun打印ScriptRunContext警告
+    set_log_level('error')
+
+    # 预热：首个会话承担模块导入与字体缓存等一次性开销，不计入结果
+    SessionDriver(0, args.timeout).run_script(1)
+
+    rows = []
+    for n_sessions in args.concurrency:
+        row = run_concurrency_level(n_sessions, args.steps, args.timeout)
+        rows.append(row)
+        print(f"{n_sessions} sessions: {row['throughput_reruns_per_s']:.2f} reruns/s, "
+              f"p99 {row['latency_p99_s'] * 1000:.1f} ms", flush=True)
+
+    print()
+    print(format_report(rows))
+
+    # 共享资源应只在预热时未命中，之后所有会话的重跑均为命中
+    print()
+    for name, stats in get_shared_asset_stats().items():
+        print(f"{name:<55} hits {stats['hits']:>7,}  misses {stats['misses']:>3}")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+import os
+import resource
+
+# 进程内存测量，供压测（load_test）和规模基准（scaling_benchmark）共用，不依赖Streamlit
+
+def get_rss_bytes():
+    """获取当前进程的常驻内存（字节）"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # 退化为峰值常驻内存（Linux上单位为KB）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,15 +1,24 @@
+import base64
+from collections.abc import Mapping
+from functools import lru_cache
+from types import MappingProxyType
+
 import pandas as pd
 import numpy as np
 
 # 基于PGS000334的完整SNP数据 - 22个阿尔茨海默病相关SNP
 # 包含从ad_snp_database_final.py提取的MAF数据
-SNP_DATA = {
+# position为GRCh37坐标，position_grch38为对应的GRCh38坐标；后者可用genotype_io.check_harmonized_positions
+# 与PGS Catalog的PGS000334协调评分文件（hmPOS_GRCh38）逐条核对
+# 原始表只用于构建下方的SNPModel，其他代码通过SNP_DATA或get_snp_model()访问
+_SNP_TABLE = {
     'rs6656401': {
         'effect_allele': 'A',
         'other_allele': 'G',
         'effect_weight': 0.14,
         'chromosome': '1',
         'position': 207692049,
+        'position_grch38': 207518704,
         'locus_name': 'CR1',
         'ref_allele': 'A',
         'alt_allele': 'G', 
@@ -21,6 +30,7 @@ SNP_DATA = {
         'effect_weight': -0.14,
         'chromosome': '2',
         'position': 127894615,
+        'position_grch38': 127137039,
         'locus_name': 'BIN1',
         'ref_allele': 'A',
         'alt_allele': 'G',
@@ -32,6 +42,7 @@ SNP_DATA = {
         'effect_weight': -0.06,
         'chromosome': '2',
         'position': 234003359,
+        'position_grch38': 233094713,
         'locus_name': 'INPP5D',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -43,6 +54,7 @@ SNP_DATA = {
         'effect_weight': -0.08,
         'chromosome': '6',
         'position': 47432637,
+        'position_grch38': 47464901,
         'locus_name': '',
         'ref_allele': 'C',
         'alt_allele': 'T',
@@ -54,6 +66,7 @@ SNP_DATA = {
         'effect_weight': 0.09,
         'chromosome': '7',
         'position': 100004446,
+        'position_grch38': 100406823,
         'locus_name': 'ZCWPW1',
         'ref_allele': 'C',
         'alt_allele': 'T',
@@ -65,6 +78,7 @@ SNP_DATA = {
         'effect_weight': 0.09,
         'chromosome': '7',
         'position': 143099107,
+        'position_grch38': 143402014,
         'locus_name': 'EPHA1',
         'ref_allele': 'T',
         'alt_allele': 'G',
@@ -76,6 +90,7 @@ SNP_DATA = {
         'effect_weight': 0.08,
         'chromosome': '8',
         'position': 27220310,
+        'position_grch38': 27362793,
         'locus_name': 'PTK2B',
         'ref_allele': 'G',
         'alt_allele': 'A',
@@ -87,6 +102,7 @@ SNP_DATA = {
         'effect_weight': -0.11,
         'chromosome': '8',
         'position': 27464519,
+        'position_grch38': 27607002,
         'locus_name': 'CLU',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -98,6 +114,7 @@ SNP_DATA = {
         'effect_weight': -0.07,
         'chromosome': '10',
         'position': 11720308,
+        'position_grch38': 11678309,
         'locus_name': 'AL512631.1',
         'ref_allele': 'A',
         'alt_allele': 'G',
@@ -109,6 +126,7 @@ SNP_DATA = {
         'effect_weight': 0.06,
         'chromosome': '11',
         'position': 47449072,
+        'position_grch38': 47427521,
         'locus_name': 'PSMC3',
         'ref_allele': 'G',
         'alt_allele': 'A',
@@ -120,6 +138,7 @@ SNP_DATA = {
         'effect_weight': 0.09,
         'chromosome': '11',
         'position': 59942815,
+        'position_grch38': 60175342,
         'locus_name': 'MS4A6A',
         'ref_allele': 'A',
         'alt_allele': 'G',
@@ -131,6 +150,7 @@ SNP_DATA = {
         'effect_weight': -0.12,
         'chromosome': '11',
         'position': 85868640,
+        'position_grch38': 86157598,
         'locus_name': 'RNU6-560P',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -142,6 +162,7 @@ SNP_DATA = {
         'effect_weight': 0.21,
         'chromosome': '11',
         'position': 121435587,
+        'position_grch38': 121564878,
         'locus_name': 'SORL1',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -153,6 +174,7 @@ SNP_DATA = {
         'effect_weight': -0.11,
         'chromosome': '14',
         'position': 53400629,
+        'position_grch38': 52933911,
         'locus_name': 'FERMT2',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -164,6 +186,7 @@ SNP_DATA = {
         'effect_weight': -0.07,
         'chromosome': '14',
         'position': 92931737,
+        'position_grch38': 92465393,
         'locus_name': 'SLC24A4',
         'ref_allele': 'G',
         'alt_allele': 'A',
@@ -175,6 +198,7 @@ SNP_DATA = {
         'effect_weight': 0.07,
         'chromosome': '15',
         'position': 59045774,
+        'position_grch38': 58753575,
         'locus_name': 'ADAM10',
         'ref_allele': 'A',
         'alt_allele': 'G',
@@ -186,6 +210,7 @@ SNP_DATA = {
         'effect_weight': 0.10,
         'chromosome': '17',
         'position': 5137047,
+        'position_grch38': 5233727,
         'locus_name': 'SCIMP',
         'ref_allele': 'G',
         'alt_allele': 'A',
@@ -197,6 +222,7 @@ SNP_DATA = {
         'effect_weight': -0.21,
         'chromosome': '17',
         'position': 61536308,
+        'position_grch38': 63458947,
         'locus_name': 'AC005828.5',
         'ref_allele': 'A',
         'alt_allele': 'G',
@@ -208,6 +234,7 @@ SNP_DATA = {
         'effect_weight': -0.08,
         'chromosome': '19',
         'position': 1039444,
+        'position_grch38': 1039445,
         'locus_name': 'CNN2',
         'ref_allele': 'C',
         'alt_allele': 'T',
@@ -219,6 +246,7 @@ SNP_DATA = {
         'effect_weight': -0.44,
         'chromosome': '19',
         'position': 45412079,
+        'position_grch38': 44908822,
         'locus_name': 'APOE',
         'ref_allele': 'C',
         'alt_allele': 'T',
@@ -230,6 +258,7 @@ SNP_DATA = {
         'effect_weight': -1.13,
         'chromosome': '19',
         'position': 45411941,
+        'position_grch38': 44908684,
         'locus_name': 'APOE',
         'ref_allele': 'T',
         'alt_allele': 'C',
@@ -241,6 +270,7 @@ SNP_DATA = {
         'effect_weight': -0.11,
         'chromosome': '20',
         'position': 54984768,
+        'position_grch38': 56409712,
         'locus_name': 'CASS4',
         'ref_allele': 'G',
         'alt_allele': 'T',
@@ -260,8 +290,192 @@ def get_effect_allele_frequency(rsid, snp_info):
         # effect_allele是ref_allele
         return 1 - alt_freq
 
-def generate_realistic_genotype(rsid, snp_info):
-    """根据MAF和Hardy-Weinberg平衡生成现实的基因型"""
+# ---------------------------------------------------------------------------
+# 模型的不可变列式表示：每个字段一列连续的只读NumPy数组，附rsid到下标的映射，
+# 每个进程只构建一次；SNP_DATA是其只读映射视图，兼容原来的嵌套字典访问方式
+# ---------------------------------------------------------------------------
+
+# 记录中不存在的可选字段（如effect_weight_se）在列中的占位值
+_ABSENT = object()
+
+class SNPRecord(Mapping):
+    """单个SNP的轻量只读记录视图，字段值直接从模型的列中读取"""
+
+    __slots__ = ('_model', '_index')
+
+    def __init__(self, model, index):
+        self._model = model
+        self._index = index
+
+    def __getitem__(self, field):
+        value = self._model.values[field][self._index]
+        if value is _ABSENT:
+            raise KeyError(field)
+        return value
+
+    def __iter__(self):
+        return (field for field, column in self._model.values.items() if column[self._index] is not _ABSENT)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    @property
+    def rsid(self):
+        return self._model.rsids[self._index]
+
+    @property
+    def index(self):
+        return self._index
+
+    def __repr__(self):
+        return f"SNPRecord({self.rsid!r}, {dict(self)!r})"
+
+class SNPRecordsView(Mapping):
+    """rsid到SNPRecord的只读映射，可替代原SNP_DATA字典"""
+
+    __slots__ = ('_model',)
+
+    def __init__(self, model):
+        self._model = model
+
+    def __getitem__(self, rsid):
+        return self._model.record(self._model.index[rsid])
+
+    def __iter__(self):
+        return iter(self._model.rsids)
+
+    def __len__(self):
+        return len(self._model.rsids)
+
+    def __contains__(self, rsid):
+        return rsid in self._model.index
+
+class SNPModel:
+    """
+    模型变异的列式（structure-of-arrays）表示
+    columns：字段名 -> 只读NumPy数组；values：字段名 -> 同一列的Python值元组（逐个访问更快）；
+    index：rsid -> 下标；另有派生列effect_freq（效应等位基因频率）和chromosome_code（整数染色体编号）
+    """
+
+    __slots__ = ('rsids', 'index', 'columns', 'values', '_records', 'records')
+
+    def __init__(self, table):
+        rsids = tuple(table)
+        fields = list(dict.fromkeys(field for snp_info in table.values() for field in snp_info))
+        values = {
+            field: tuple(snp_info.get(field, _ABSENT) for snp_info in table.values())
+            for field in fields
+        }
+
+        columns = {}
+        for field, column in values.items():
+            if any(value is _ABSENT for value in column):
+                # 可选的数值字段缺失时记为NaN，其他字段记为None
+                present = [value for value in column if value is not _ABSENT]
+                numeric = all(isinstance(value, (int, float)) for value in present)
+                array = np.array([(np.nan if numeric else None) if value is _ABSENT else value
+                                  for value in column], dtype=np.float64 if numeric else object)
+            else:
+                array = np.array(column)
+            columns[field] = array
+        columns['effect_freq'] = np.array(
+            [get_effect_allele_frequency(rsid, snp_info) for rsid, snp_info in table.items()]
+        )
+        columns['chromosome_code'] = np.array([int(chrom) for chrom in values['chromosome']])
+        for array in columns.values():
+            array.setflags(write=False)
+
+        set_field = super().__setattr__
+        set_field('rsids', rsids)
+        set_field('index', MappingProxyType({rsid: i for i, rsid in enumerate(rsids)}))
+        set_field('columns', MappingProxyType(columns))
+        set_field('values', MappingProxyType(values))
+        set_field('_records', tuple(SNPRecord(self, i) for i in range(len(rsids))))
+        set_field('records', SNPRecordsView(self))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __len__(self):
+        return len(self.rsids)
+
+    def record(self, index):
+        return self._records[index]
+
+# 进程级共享资源：不依赖用户状态的派生数据（模型表示、参考曲线、图形几何等）在每个服务进程中
+# 只构建一次，所有Streamlit会话只读共享；命中/未命中计数来自functools.lru_cache
+SHARED_ASSETS = {}
+
+def shared_asset(func=None, *, warm_args=None):
+    """
+    将构建函数注册为进程级共享资源（按参数缓存）；warm_args为返回预热参数元组列表的函数，默认无参数调用一次。
+    同名资源已注册时直接返回已有的缓存，Streamlit每次重跑重新执行app.py中的定义也不会丢失缓存
+    """
+    def register(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+        if name not in SHARED_ASSETS:
+            cached = lru_cache(maxsize=None)(func)
+            cached.warm_args = warm_args or (lambda: [()])
+            SHARED_ASSETS[name] = cached
+        return SHARED_ASSETS[name]
+    return register if func is None else register(func)
+
+def warm_shared_assets():
+    """按各资源的预热参数构建所有已注册的共享资源，返回(构建的条目数, 耗时秒数)"""
+    import time
+    start = time.perf_counter()
+    n_built = 0
+    for cached in list(SHARED_ASSETS.values()):
+        for args in cached.warm_args():
+            cached(*args)
+            n_built += 1
+    return n_built, time.perf_counter() - start
+
+def get_shared_asset_stats():
+    """各共享资源的命中数、未命中数和缓存条目数"""
+    stats = {}
+    for name, cached in SHARED_ASSETS.items():
+        info = cached.cache_info()
+        stats[name] = {'hits': info.hits, 'misses': info.misses, 'entries': info.currsize}
+    return stats
+
+@shared_asset
+def get_snp_model():
+    """返回进程内共享的模型列式表示（只构建一次）"""
+    return SNPModel(_SNP_TABLE)
+
+SNP_DATA = get_snp_model().records
+
+@shared_asset
+def get_chromosome_snp_groups():
+    """按染色体编号排序的(染色体, 该染色体上的rsid元组)，染色体内保持模型顺序"""
+    model = get_snp_model()
+    order = np.argsort(model.columns['chromosome_code'], kind='stable')
+    groups = {}
+    for i in order:
+        groups.setdefault(model.values['chromosome'][i], []).append(model.rsids[i])
+    return tuple((chrom, tuple(rsids)) for chrom, rsids in groups.items())
+
+def as_seed_sequence(seed=None):
+    """将整数种子、SeedSequence或Generator统一转换为SeedSequence"""
+    if isinstance(seed, np.random.SeedSequence):
+        return seed
+    if isinstance(seed, np.random.Generator):
+        # 从Generator派生新的子序列，同一个Generator多次调用得到不同但可复现的流
+        return seed.bit_generator.seed_seq.spawn(1)[0]
+    return np.random.SeedSequence(seed)
+
+def spawn_child_seed(seed_seq, index):
+    """返回seed_seq的第index个子序列，与seed_seq.spawn(index + 1)[index]相同，但无需生成前面的子序列"""
+    return np.random.SeedSequence(
+        seed_seq.entropy,
+        spawn_key=tuple(seed_seq.spawn_key) + (index,),
+        pool_size=seed_seq.pool_size
+    )
+
+def generate_realistic_genotype(rsid, snp_info, rng=None):
+    """根据MAF和Hardy-Weinberg平衡生成现实的基因型，rng可为种子或Generator"""
+    rng = np.random.default_rng(rng)
     effect_freq = get_effect_allele_frequency(rsid, snp_info)
     other_freq = 1 - effect_freq
     
@@ -274,7 +488,7 @@ def generate_realistic_genotype(rsid, snp_info):
     prob_other_homo = other_freq ** 2          # aa
     
     # 根据概率随机选择
-    rand = np.random.random()
+    rand = rng.random()
     if rand < prob_effect_homo:
         return effect_allele + effect_allele
     elif rand < prob_effect_homo + prob_hetero:
@@ -304,72 +518,98 @@ def calculate_genotype_score(genotype, effect_allele, other_allele, weight):
 
 def calculate_prs(genotypes):
     """计算多基因风险评分（PRS）"""
+    model = get_snp_model()
+    effect_alleles = model.values['effect_allele']
+    other_alleles = model.values['other_allele']
+    weights = model.values['effect_weight']
     total_score = 0
     
     for rsid, genotype in genotypes.items():
-        if rsid in SNP_DATA:
-            snp_info = SNP_DATA[rsid]
-            score = calculate_genotype_score(
-                genotype,
-                snp_info['effect_allele'],
-                snp_info['other_allele'],
-                snp_info['effect_weight']
-            )
-            total_score += score
+        i = model.index.get(rsid)
+        if i is not None:
+            total_score += calculate_genotype_score(genotype, effect_alleles[i], other_alleles[i], weights[i])
     
     return total_score
 
-def initialize_default_genotypes():
+def initialize_default_genotypes(rng=None):
     """初始化默认基因型 - 使用基于MAF的现实化随机生成"""
+    rng = np.random.default_rng(rng)
     genotypes = {}
     
     for rsid, snp_info in SNP_DATA.items():
-        genotypes[rsid] = generate_realistic_genotype(rsid, snp_info)
+        genotypes[rsid] = generate_realistic_genotype(rsid, snp_info, rng)
     
     return genotypes
 
-def generate_realistic_genotypes():
-    """生成基于Hardy-Weinberg平衡的现实化基因型集合"""
+def generate_realistic_genotypes(rng=None):
+    """生成基于Hardy-Weinberg平衡的现实化基因型集合，相同种子得到相同结果"""
+    rng = np.random.default_rng(rng)
     genotypes = {}
     
     for rsid, snp_info in SNP_DATA.items():
-        genotypes[rsid] = generate_realistic_genotype(rsid, snp_info)
+        genotypes[rsid] = generate_realistic_genotype(rsid, snp_info, rng)
     
     return genotypes
 
+# 基于PGS000334的分数范围调整风险分层 - 按分数从低到高排列
+RISK_TIERS = [
+    {
+        'level': 'Low Risk',
+        'color': 'green',
+        'description': 'Genetic risk below average'
+    },
+    {
+        'level': 'Average Risk',
+        'color': 'blue',
+        'description': 'Genetic risk near population average'
+    },
+    {
+        'level': 'Moderate Risk',
+        'color': 'orange', 
+        'description': 'Genetic risk slightly above average'
+    },
+    {
+        'level': 'High Risk',
+        'color': 'red',
+        'description': 'Genetic risk significantly above average'
+    }
+]
+
+# 风险分层的分界点：分数严格大于分界点才进入更高一层
+RISK_THRESHOLDS = np.array([-0.5, 0.0, 0.5])
+
+# 得分缺失（NaN）时的分层/分段编号及其标签；searchsorted会把NaN排在所有分界点之后，需单独标记
+UNKNOWN_CATEGORY_CODE = -1
+UNKNOWN_CATEGORY = MappingProxyType({
+    'level': 'Unknown',
+    'color': '#6C757D',
+    'description': 'PRS could not be computed'
+})
+
+def _classify(thresholds, values, side):
+    values = np.asarray(values, dtype=np.float64)
+    codes = np.searchsorted(thresholds, values, side=side).astype(np.int8)
+    return np.where(np.isnan(values), np.int8(UNKNOWN_CATEGORY_CODE), codes)[()]
+
+def get_category(code, table):
+    """分层/分段编号对应的标签表条目（只读视图），UNKNOWN_CATEGORY_CODE对应UNKNOWN_CATEGORY"""
+    code = int(code)
+    return UNKNOWN_CATEGORY if code == UNKNOWN_CATEGORY_CODE else MappingProxyType(table[code])
+
+def classify_risk_tiers(prs_scores):
+    """批量将PRS映射为RISK_TIERS中的分层编号（int8），NaN得分为UNKNOWN_CATEGORY_CODE"""
+    return _classify(RISK_THRESHOLDS, prs_scores, 'left')
+
 def get_risk_interpretation(prs_score):
-    """解释PRS分数的风险含义"""
-    # 基于PGS000334的分数范围调整风险分层
-    if prs_score > 0.5:
-        return {
-            'level': 'High Risk',
-            'color': 'red',
-            'description': 'Genetic risk significantly above average'
-        }
-    elif prs_score > 0.0:
-        return {
-            'level': 'Moderate Risk',
-            'color': 'orange', 
-            'description': 'Genetic risk slightly above average'
-        }
-    elif prs_score > -0.5:
-        return {
-            'level': 'Average Risk',
-            'color': 'blue',
-            'description': 'Genetic risk near population average'
-        }
-    else:
-        return {
-            'level': 'Low Risk',
-            'color': 'green',
-            'description': 'Genetic risk below average'
-        }
+    """解释PRS分数的风险含义（RISK_TIERS中对应分层的只读视图），NaN得分返回UNKNOWN_CATEGORY"""
+    return get_category(classify_risk_tiers(prs_score), RISK_TIERS)
 
 def get_snp_summary_stats():
     """获取SNP汇总统计"""
-    total_snps = len(SNP_DATA)
-    positive_weights = sum(1 for snp in SNP_DATA.values() if snp['effect_weight'] > 0)
-    negative_weights = sum(1 for snp in SNP_DATA.values() if snp['effect_weight'] < 0)
+    weights = get_snp_model().columns['effect_weight']
+    total_snps = len(weights)
+    positive_weights = int((weights > 0).sum())
+    negative_weights = int((weights < 0).sum())
     
     return {
         'total_snps': total_snps,
@@ -379,15 +619,1301 @@ def get_snp_summary_stats():
 
 def get_frequency_stats():
     """获取频率统计信息，用于调试和验证"""
+    model = get_snp_model()
+    effect_freqs = model.columns['effect_freq'].tolist()
     stats = {}
     
-    for rsid, snp_info in SNP_DATA.items():
-        effect_freq = get_effect_allele_frequency(rsid, snp_info)
+    for rsid, effect_allele, effect_freq, weight in zip(
+        model.rsids, model.values['effect_allele'], effect_freqs, model.values['effect_weight']
+    ):
         stats[rsid] = {
-            'effect_allele': snp_info['effect_allele'],
+            'effect_allele': effect_allele,
             'effect_freq': effect_freq,
             'other_freq': 1 - effect_freq,
-            'weight': snp_info['effect_weight']
+            'weight': weight
         }
     
-    return stats
\ No newline at end of file
+    return stats
+
+# 基于Hardy-Weinberg平衡的欧洲人群PRS分布参数及理论范围
+POPULATION_MEAN = -2.4101
+POPULATION_STD = 0.6444
+THEORETICAL_MIN = -5.46
+THEORETICAL_MAX = 1.86
+
+def calculate_percentile(prs_score):
+    """计算PRS在欧洲人群中的百分位（限制在0.1-99.9），支持标量和数组"""
+    from scipy.stats import norm
+    percentile = norm.cdf(prs_score, loc=POPULATION_MEAN, scale=POPULATION_STD) * 100
+    percentile = np.clip(percentile, 0.1, 99.9)
+    return float(percentile) if np.ndim(percentile) == 0 else percentile
+
+# 百分位分段 - 与RISK_TIERS结构相同的标签/颜色表，按百分位从低到高排列
+PERCENTILE_BANDS = [
+    {'level': 'Very Low Risk', 'color': '#7DA494'},
+    {'level': 'Below Average', 'color': '#ABC8E5'},
+    {'level': 'Average Range', 'color': '#6C757D'},
+    {'level': 'Above Average', 'color': '#E5A79A'},
+    {'level': 'Very High Risk', 'color': '#C16E71'}
+]
+
+# 百分位分段的分界点：百分位大于等于分界点即进入更高一段
+PERCENTILE_BAND_THRESHOLDS = np.array([5, 25, 75, 95])
+
+def classify_percentile_bands(percentiles):
+    """批量将百分位映射为PERCENTILE_BANDS中的分段编号（int8），NaN百分位为UNKNOWN_CATEGORY_CODE"""
+    return _classify(PERCENTILE_BAND_THRESHOLDS, percentiles, 'right')
+
+def get_percentile_band(percentile):
+    """单个百分位所在的分段（PERCENTILE_BANDS中对应分段的只读视图），NaN返回UNKNOWN_CATEGORY"""
+    return get_category(classify_percentile_bands(percentile), PERCENTILE_BANDS)
+
+def classify_scores(prs_scores):
+    """批量计算百分位，并在同一次调用中返回(百分位, 风险分层编号, 百分位分段编号)"""
+    percentiles = calculate_percentile(prs_scores)
+    return percentiles, classify_risk_tiers(prs_scores), classify_percentile_bands(percentiles)
+
+def codes_to_categorical(codes, table):
+    """将分层/分段编号转换为有序的pandas分类数组，类别取自对应的标签表；UNKNOWN_CATEGORY_CODE为缺失值"""
+    return pd.Categorical.from_codes(codes, categories=[entry['level'] for entry in table], ordered=True)
+
+# 模型变异的固定顺序 - 剂量数组和URL令牌都按此顺序编码
+SNP_IDS = tuple(SNP_DATA.keys())
+
+# 缺失基因型的剂量值（2-bit编码中对应3）
+MISSING_DOSAGE = -1
+
+def genotype_to_dosage(genotype, effect_allele, other_allele):
+    """将基因型字符串转换为效应等位基因剂量（0/1/2）"""
+    if not genotype or len(genotype) != 2:
+        return MISSING_DOSAGE
+    if any(allele not in (effect_allele, other_allele) for allele in genotype):
+        return MISSING_DOSAGE
+    return genotype.count(effect_allele)
+
+def dosage_to_genotype(dosage, effect_allele, other_allele):
+    """将剂量转换回应用使用的基因型字符串，缺失返回None"""
+    if dosage < 0 or dosage > 2:
+        return None
+    return get_genotype_options(effect_allele, other_allele)[dosage]
+
+def genotypes_to_dosages(genotypes):
+    """将{rsid: 基因型}字典转换为按SNP_IDS排列的int8剂量数组"""
+    model = get_snp_model()
+    return np.array([
+        genotype_to_dosage(genotypes.get(rsid), effect_allele, other_allele)
+        for rsid, effect_allele, other_allele in zip(
+            model.rsids, model.values['effect_allele'], model.values['other_allele']
+        )
+    ], dtype=np.int8)
+
+def dosages_to_genotypes(dosages):
+    """将剂量数组转换回{rsid: 基因型}字典，缺失的SNP不出现在结果中"""
+    model = get_snp_model()
+    genotypes = {}
+    for rsid, dosage, effect_allele, other_allele in zip(
+        model.rsids, np.asarray(dosages).tolist(), model.values['effect_allele'], model.values['other_allele']
+    ):
+        genotype = dosage_to_genotype(dosage, effect_allele, other_allele)
+        if genotype is not None:
+            genotypes[rsid] = genotype
+    return genotypes
+
+def pack_dosages(dosages):
+    """按2 bit/变异打包剂量（最后一维），缺失编码为3"""
+    dosages = np.asarray(dosages)
+    codes = np.where((dosages < 0) | (dosages > 2), 3, dosages).astype(np.uint8)
+    n_variants = codes.shape[-1]
+    padding = (-n_variants) % 4
+    if padding:
+        pad_width = [(0, 0)] * (codes.ndim - 1) + [(0, padding)]
+        codes = np.pad(codes, pad_width, constant_values=3)
+    codes = codes.reshape(codes.shape[:-1] + (-1, 4))
+    return (codes[..., 0] | (codes[..., 1] << 2) | (codes[..., 2] << 4) | (codes[..., 3] << 6)).astype(np.uint8)
+
+def unpack_dosages(packed, n_variants):
+    """解包pack_dosages的结果为int8剂量数组"""
+    packed = np.asarray(packed, dtype=np.uint8)
+    shifts = np.array([0, 2, 4, 6], dtype=np.uint8)
+    codes = (packed[..., np.newaxis] >> shifts) & 3
+    codes = codes.reshape(packed.shape[:-1] + (-1,))[..., :n_variants]
+    dosages = codes.astype(np.int8)
+    dosages[dosages == 3] = MISSING_DOSAGE
+    return dosages
+
+def encode_dosage_token(dosages):
+    """将剂量数组编码为URL安全的短令牌（2 bit/变异 + base64）"""
+    if len(dosages) != len(SNP_IDS):
+        raise ValueError(f"Expected {len(SNP_IDS)} dosages, got {len(dosages)}")
+    packed = pack_dosages(dosages)
+    return base64.urlsafe_b64encode(packed.tobytes()).decode('ascii').rstrip('=')
+
+def decode_dosage_token(token):
+    """从URL令牌恢复剂量数组，令牌无效时抛出ValueError"""
+    n_bytes = (len(SNP_IDS) + 3) // 4
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid genotype token: {token!r}") from e
+    if len(raw) != n_bytes:
+        raise ValueError(f"Invalid genotype token length: {token!r}")
+    return unpack_dosages(np.frombuffer(raw, dtype=np.uint8), len(SNP_IDS))
+
+def get_effect_weights():
+    """按SNP_IDS顺序返回效应权重数组（只读）"""
+    return get_snp_model().columns['effect_weight']
+
+def calculate_prs_batch(dosages, weights=None, block_cells=1 << 22):
+    """批量计算PRS：dosages为(样本数, 变异数)的剂量矩阵，缺失剂量不计分"""
+    if weights is None:
+        weights = get_effect_weights()
+    dosages = np.asarray(dosages)
+    if dosages.ndim == 1:
+        return calculate_prs_batch(dosages[np.newaxis, :], weights, block_cells)[0]
+
+    # 按行分块转换为浮点，临时数组不超过block_cells个元素
+    rows_per_block = max(1, block_cells // max(1, dosages.shape[1]))
+    scores = np.empty(dosages.shape[0])
+    for lo in range(0, dosages.shape[0], rows_per_block):
+        block = dosages[lo:lo + rows_per_block]
+        valid = (block >= 0) & (block <= 2)
+        scores[lo:lo + len(block)] = np.where(valid, block, 0).astype(np.float64) @ weights
+    return scores
+
+# 缺失率超过此阈值的样本标记为高缺失率
+MAX_MISSING_RATE = 0.1
+
+def calculate_prs_imputed(dosages, missing=None, weights=None, effect_freqs=None,
+                          max_missing_rate=MAX_MISSING_RATE, block_cells=1 << 22):
+    """
+    批量计算PRS，缺失基因型以期望剂量2p填补（p为效应等位基因频率）
+    missing为缺失掩码，默认将0-2之外的剂量视为缺失；填补与检出率统计在同一次分块遍历中完成
+    返回(得分, 每个样本的检出率, 缺失率超过阈值的标记)
+    """
+    if weights is None:
+        weights = get_effect_weights()
+    if effect_freqs is None:
+        effect_freqs = get_effect_frequencies()
+    dosages = np.asarray(dosages)
+    if dosages.ndim == 1:
+        missing = None if missing is None else np.asarray(missing)[np.newaxis, :]
+        scores, call_rate, flagged = calculate_prs_imputed(
+            dosages[np.newaxis, :], missing, weights, effect_freqs, max_missing_rate, block_cells
+        )
+        return scores[0], call_rate[0], flagged[0]
+
+    expected = 2 * np.asarray(effect_freqs, dtype=np.float64)
+    n_variants = max(1, dosages.shape[1])
+    rows_per_block = max(1, block_cells // n_variants)
+    scores = np.empty(dosages.shape[0])
+    n_called = np.empty(dosages.shape[0], dtype=np.int64)
+    for lo in range(0, dosages.shape[0], rows_per_block):
+        block = dosages[lo:lo + rows_per_block]
+        valid = (block >= 0) & (block <= 2)
+        if missing is not None:
+            valid &= ~np.asarray(missing[lo:lo + rows_per_block], dtype=bool)
+        scores[lo:lo + len(block)] = np.where(valid, block, expected) @ weights
+        n_called[lo:lo + len(block)] = valid.sum(axis=1)
+
+    call_rate = n_called / n_variants
+    return scores, call_rate, (1 - call_rate) > max_missing_rate
+
+# 杂合率或效应等位基因数偏离Hardy-Weinberg期望超过此Z值的样本标记为离群
+QC_Z_THRESHOLD = 3.0
+
+def calculate_prs_qc(dosages, missing=None, weights=None, effect_freqs=None,
+                     max_missing_rate=MAX_MISSING_RATE, z_threshold=QC_Z_THRESHOLD, block_cells=1 << 22):
+    """
+    与calculate_prs_imputed相同的填补评分，并在同一次分块遍历中计算每个样本的QC指标：
+    检出率、杂合率、效应等位基因总数、携带效应等位基因的SNP数（总数/风险/保护）。
+    杂合数和效应等位基因数按已检出变异在Hardy-Weinberg平衡下的期望和方差换算为Z值，
+    超过z_threshold时标记为离群；期望只依赖样本自身，分块或流式处理时结果不变
+    返回(得分, 列名到NumPy数组的字典)
+    """
+    if weights is None:
+        weights = get_effect_weights()
+    if effect_freqs is None:
+        effect_freqs = get_effect_frequencies()
+    dosages = np.atleast_2d(np.asarray(dosages))
+    weights = np.asarray(weights, dtype=np.float64)
+    freqs = np.asarray(effect_freqs, dtype=np.float64)
+
+    expected = 2 * freqs
+    het_prob = 2 * freqs * (1 - freqs)
+    # 杂合数 ~ ΣBernoulli(2pq)，效应等位基因数 ~ ΣBinomial(2, p)；各列依次为两者的期望和方差
+    moments = np.column_stack([het_prob, het_prob * (1 - het_prob), expected, het_prob])
+    # 变异分组指示矩阵：风险、保护、权重为0
+    groups = np.column_stack([weights > 0, weights < 0, weights == 0]).astype(np.float64)
+    # 缺失位置的修正项：填补得分、缺失计数和需从期望中扣除的矩
+    missing_terms = np.column_stack([expected * weights, np.ones(len(weights)), moments])
+
+    n_samples = dosages.shape[0]
+    n_variants = max(1, dosages.shape[1])
+    rows_per_block = max(1, block_cells // n_variants)
+    scores = np.empty(n_samples)
+    sums = np.empty((n_samples, 3))           # 各组已检出剂量之和 Σd
+    square_sums = np.empty((n_samples, 3))    # 各组已检出剂量平方和 Σd²
+    corrections = np.zeros((n_samples, 2 + moments.shape[1]))
+    for lo in range(0, n_samples, rows_per_block):
+        hi = min(n_samples, lo + rows_per_block)
+        block = dosages[lo:hi]
+        invalid = (block < 0) | (block > 2)
+        if missing is not None:
+            invalid |= np.asarray(missing[lo:hi], dtype=bool)
+        called = block.astype(np.float64)
+        # 缺失通常集中在少数样本，只对含缺失的行清零缺失位置并计算修正项
+        rows = np.flatnonzero(invalid.any(axis=1))
+        if rows.size:
+            row_invalid = invalid[rows]
+            called[rows] = np.where(row_invalid, 0, called[rows])
+            corrections[lo + rows] = row_invalid.astype(np.float64) @ missing_terms
+        scores[lo:hi] = called @ weights
+        sums[lo:hi] = called @ groups
+        square_sums[lo:hi] = (called * called) @ groups
+
+    # 剂量只取0/1/2：Σd = 杂合数 + 2·纯合数，Σd² = 杂合数 + 4·纯合数
+    homozygous = (square_sums - sums) / 2
+    carriers = np.rint(sums - homozygous).astype(np.int32)
+    scores += corrections[:, 0]
+    n_called = n_variants - corrections[:, 1]
+    expected_moments = moments.sum(axis=0) - corrections[:, 2:]
+    n_het = np.rint(sums - 2 * homozygous).sum(axis=1)
+    allele_count = np.rint(sums.sum(axis=1)).astype(np.int32)
+
+    def z_score(observed, mean, variance):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = (observed - mean) / np.sqrt(variance)
+        return np.where(variance > 0, z, 0.0)
+
+    call_rate = n_called / n_variants
+    het_z = z_score(n_het, expected_moments[:, 0], expected_moments[:, 1])
+    allele_z = z_score(allele_count, expected_moments[:, 2], expected_moments[:, 3])
+    return scores, {
+        'call_rate': call_rate,
+        'high_missingness': (1 - call_rate) > max_missing_rate,
+        'het_rate': n_het / np.maximum(n_called, 1),
+        'het_outlier': np.abs(het_z) > z_threshold,
+        'effect_allele_count': allele_count,
+        'effect_allele_outlier': np.abs(allele_z) > z_threshold,
+        'effect_snps': carriers.sum(axis=1, dtype=np.int32),
+        'risk_snps': carriers[:, 0],
+        'protective_snps': carriers[:, 1]
+    }
+
+def calculate_prs_packed(packed, weights=None, block_cells=1 << 22):
+    """
+    直接对pack_dosages打包的基因型计分，不解包整个矩阵
+    每个字节含4个变异，预先为每个字节位置建立256项的得分查找表
+    """
+    if weights is None:
+        weights = get_effect_weights()
+    packed = np.atleast_2d(np.asarray(packed, dtype=np.uint8))
+    n_bytes = packed.shape[-1]
+    padded_weights = np.zeros(n_bytes * 4)
+    padded_weights[:len(weights)] = weights
+
+    # lookup[b, v]：第b个字节取值为v时4个变异的得分之和（编码3即缺失计0分）
+    codes = ((np.arange(256)[:, np.newaxis] >> np.array([0, 2, 4, 6])) & 3).astype(np.float64)
+    codes[codes == 3] = 0
+    lookup = padded_weights.reshape(n_bytes, 4) @ codes.T
+
+    # 按块查表，每块的中间结果不超过block_cells个元素
+    byte_index = np.arange(n_bytes)
+    rows_per_block = max(1, block_cells // n_bytes)
+    scores = np.empty(packed.shape[0])
+    for lo in range(0, packed.shape[0], rows_per_block):
+        block = packed[lo:lo + rows_per_block]
+        scores[lo:lo + len(block)] = lookup[byte_index, block].sum(axis=1)
+    return scores
+
+# ---------------------------------------------------------------------------
+# 稀疏剂量：罕见变异为主的模型中绝大多数剂量为0（纯合非效应基因型），
+# CSR只存非零剂量及其列号，评分为一次稀疏矩阵-向量乘法
+# ---------------------------------------------------------------------------
+
+class SparseDosages:
+    """
+    CSR格式的剂量矩阵：matrix只含1/2剂量（int8数据、int32列号），
+    缺失位置单独存为布尔CSR矩阵missing，评分时与calculate_prs_batch一样不计分
+    """
+
+    def __init__(self, matrix, missing):
+        self.matrix = matrix
+        self.missing = missing
+
+    @classmethod
+    def from_dense(cls, dosages, block_cells=1 << 22):
+        from scipy.sparse import csr_array
+        dosages = np.atleast_2d(np.asarray(dosages))
+        n_samples, n_variants = dosages.shape
+        rows_per_block = max(1, block_cells // max(1, n_variants))
+        parts = {'matrix': ([], [], []), 'missing': ([], [], [])}
+        # 按行分块提取非零位置，临时数组不超过block_cells个元素
+        for lo in range(0, n_samples, rows_per_block):
+            block = dosages[lo:lo + rows_per_block]
+            for name, mask in (('matrix', (block > 0) & (block <= 2)), ('missing', (block < 0) | (block > 2))):
+                data, indices, counts = parts[name]
+                rows, cols = np.nonzero(mask)
+                data.append(block[rows, cols].astype(np.int8) if name == 'matrix' else np.ones(len(rows), dtype=bool))
+                indices.append(cols.astype(np.int32))
+                counts.append(mask.sum(axis=1))
+
+        def build(data, indices, counts, dtype):
+            indptr = np.zeros(n_samples + 1, dtype=np.int64)
+            if counts:
+                np.cumsum(np.concatenate(counts), out=indptr[1:])
+            if indptr[-1] < np.iinfo(np.int32).max:
+                indptr = indptr.astype(np.int32)
+            data = np.concatenate(data) if data else np.empty(0, dtype=dtype)
+            indices = np.concatenate(indices) if indices else np.empty(0, dtype=np.int32)
+            return csr_array((data, indices, indptr), shape=(n_samples, n_variants))
+
+        return cls(build(*parts['matrix'], np.int8), build(*parts['missing'], bool))
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def nbytes(self):
+        return sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in (self.matrix, self.missing))
+
+    def score(self, weights=None, block_cells=1 << 22):
+        from scipy.sparse import csr_array
+        if weights is None:
+            weights = get_effect_weights()
+        weights = np.asarray(weights, dtype=np.float64)
+        matrix = self.matrix
+        indptr = matrix.indptr
+        n_samples = matrix.shape[0]
+        scores = np.empty(n_samples)
+        # 按非零数分块相乘：int8数据转换为浮点的临时数组不超过block_cells个元素
+        lo = 0
+        while lo < n_samples:
+            hi = int(np.searchsorted(indptr, indptr[lo] + block_cells, side='right')) - 1
+            hi = min(max(hi, lo + 1), n_samples)
+            start, end = indptr[lo], indptr[hi]
+            block = csr_array((matrix.data[start:end], matrix.indices[start:end], indptr[lo:hi + 1] - start),
+                              shape=(hi - lo, matrix.shape[1]))
+            scores[lo:hi] = block @ weights
+            lo = hi
+        return scores
+
+    def to_dense(self):
+        dosages = self.matrix.toarray().astype(np.int8)
+        dosages[self.missing.toarray()] = MISSING_DOSAGE
+        return dosages
+
+# 自动选择剂量布局的密度阈值：CSR每个非零剂量约占5字节（1字节剂量 + 4字节列号），
+# 2 bit打包为每个剂量0.25字节，因此非零（含缺失）比例低于5%时稀疏布局更省内存，
+# 评分时的工作量也只与非零数成正比
+SPARSE_DENSITY_THRESHOLD = 0.05
+
+# 非稀疏时不超过此大小的矩阵保持int8稠密布局（评分最快），更大的矩阵按2 bit打包
+DENSE_LAYOUT_MAX_BYTES = 1 << 28
+
+DOSAGE_LAYOUTS = ('dense', 'packed', 'sparse')
+
+def measure_dosage_density(dosages, max_rows=100_000, rng=0):
+    """非零（含缺失）剂量的比例；样本数较多时只在随机抽取的max_rows行上测量"""
+    dosages = np.atleast_2d(np.asarray(dosages))
+    if dosages.shape[0] > max_rows:
+        rows = np.sort(np.random.default_rng(rng).choice(dosages.shape[0], max_rows, replace=False))
+        dosages = dosages[rows]
+    return float(np.count_nonzero(dosages)) / max(dosages.size, 1)
+
+def choose_dosage_layout(dosages, allow_packed=True):
+    """
+    按实测密度在dense/packed/sparse之间选择：稀疏时用CSR；
+    否则较小的矩阵保持稠密，超过DENSE_LAYOUT_MAX_BYTES时用2 bit打包（allow_packed为False时仍保持稠密）
+    """
+    if measure_dosage_density(dosages) < SPARSE_DENSITY_THRESHOLD:
+        return 'sparse'
+    if allow_packed and np.asarray(dosages).size > DENSE_LAYOUT_MAX_BYTES:
+        return 'packed'
+    return 'dense'
+
+class CompactDosages:
+    """以dense（int8）、packed（2 bit）或sparse（CSR）布局保存的剂量矩阵，提供统一的评分接口"""
+
+    def __init__(self, dosages, layout=None):
+        if isinstance(dosages, SparseDosages):
+            # 已构建好的CSR（如剂量存储中持久化的副本）直接使用
+            self.layout, self.n_variants, self.data = 'sparse', dosages.shape[1], dosages
+            return
+        dosages = np.atleast_2d(np.asarray(dosages))
+        self.layout = layout or choose_dosage_layout(dosages)
+        if self.layout not in DOSAGE_LAYOUTS:
+            raise ValueError(f"Unknown dosage layout: {self.layout}")
+        self.n_variants = dosages.shape[1]
+        if self.layout == 'dense':
+            self.data = np.ascontiguousarray(dosages, dtype=np.int8)
+        elif self.layout == 'packed':
+            self.data = pack_dosages(dosages)
+        else:
+            self.data = SparseDosages.from_dense(dosages)
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def score(self, weights=None):
+        if self.layout == 'dense':
+            return calculate_prs_batch(self.data, weights)
+        if self.layout == 'packed':
+            return calculate_prs_packed(self.data, weights)
+        return self.data.score(weights)
+
+    def to_dense(self):
+        if self.layout == 'dense':
+            return self.data
+        if self.layout == 'packed':
+            return unpack_dosages(self.data, self.n_variants)
+        return self.data.to_dense()
+
+def count_effect_snps_batch(dosages, weights=None):
+    """
+    批量统计携带效应等位基因的SNP数，返回(总数, 风险SNP数, 保护SNP数)；
+    weights为按SNP_IDS排列的模型权重（默认PGS000334），权重为0（不在模型中）的变异不计入
+    """
+    carriers = (np.asarray(dosages) > 0) & (np.asarray(dosages) <= 2)
+    weights = get_effect_weights() if weights is None else np.asarray(weights)
+    return (
+        carriers[..., weights != 0].sum(axis=-1),
+        carriers[..., weights > 0].sum(axis=-1),
+        carriers[..., weights < 0].sum(axis=-1)
+    )
+
+# 队列模拟按固定大小的块划分，每块使用spawn_child_seed派生的独立随机流；
+# 块边界与进程数无关，因此任意进程数下的结果与单进程逐位一致
+SIMULATION_CHUNK_SIZE = 65536
+
+def simulate_dosage_chunk(seed_seq, chunk_index, n_samples, effect_freqs, chunk_size=SIMULATION_CHUNK_SIZE):
+    """模拟队列中第chunk_index块样本的剂量，只使用该块专属的子随机流"""
+    rng = np.random.default_rng(spawn_child_seed(seed_seq, chunk_index))
+    n_rows = min(chunk_size, n_samples - chunk_index * chunk_size)
+    n_variants = len(effect_freqs)
+    dosages = np.empty((n_rows, n_variants), dtype=np.int8)
+    # 每个效应等位基因独立抽样，剂量服从Binomial(2, p)；分段生成以免int64中间数组占用过多内存
+    rows_per_block = max(1, (1 << 22) // max(1, n_variants))
+    for lo in range(0, n_rows, rows_per_block):
+        hi = min(n_rows, lo + rows_per_block)
+        dosages[lo:hi] = rng.binomial(2, effect_freqs, size=(hi - lo, n_variants))
+    return dosages
+
+def simulate_cohort_dosages(n_samples, rng=None, effect_freqs=None, chunk_size=SIMULATION_CHUNK_SIZE, workers=1):
+    """
+    根据MAF和Hardy-Weinberg平衡模拟队列的剂量矩阵，默认使用模型的效应等位基因频率
+    rng可为整数种子、SeedSequence或Generator；workers>1时各块在进程池中并行生成，结果与单进程相同
+    """
+    seed_seq = as_seed_sequence(rng)
+    if effect_freqs is None:
+        effect_freqs = get_effect_frequencies()
+    effect_freqs = np.asarray(effect_freqs, dtype=np.float64)
+
+    dosages = np.empty((n_samples, len(effect_freqs)), dtype=np.int8)
+    chunk_indices = range((n_samples + chunk_size - 1) // chunk_size)
+
+    if workers <= 1:
+        for k in chunk_indices:
+            chunk = simulate_dosage_chunk(seed_seq, k, n_samples, effect_freqs, chunk_size)
+            dosages[k * chunk_size:k * chunk_size + len(chunk)] = chunk
+        return dosages
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(simulate_dosage_chunk, seed_seq, k, n_samples, effect_freqs, chunk_size): k
+            for k in chunk_indices
+        }
+        for future, k in futures.items():
+            chunk = future.result()
+            dosages[k * chunk_size:k * chunk_size + len(chunk)] = chunk
+    return dosages
+
+SCORE_SEGMENT_LEVELS = ('chromosome', 'locus')
+
+@lru_cache(maxsize=None)
+def get_score_segments(level='chromosome'):
+    """
+    按(染色体, 位置)排列模型变异，并划分为连续的段（每条染色体，或每个位点）
+    返回(段标签元组, 排序后的变异下标, 各段起点)，结果只读并按进程缓存
+    """
+    if level not in SCORE_SEGMENT_LEVELS:
+        raise ValueError(f"Unknown segment level {level!r}, expected one of {SCORE_SEGMENT_LEVELS}")
+    order = np.array(sorted(
+        range(len(SNP_IDS)),
+        key=lambda i: (int(SNP_DATA[SNP_IDS[i]]['chromosome']), SNP_DATA[SNP_IDS[i]]['position'])
+    ))
+    if level == 'chromosome':
+        keys = [SNP_DATA[SNP_IDS[i]]['chromosome'] for i in order]
+    else:
+        # 同一染色体上相邻且locus_name相同的变异归为一个位点，未注释的变异单独成段
+        keys = [
+            f"chr{SNP_DATA[SNP_IDS[i]]['chromosome']}:{SNP_DATA[SNP_IDS[i]]['locus_name'] or SNP_IDS[i]}"
+            for i in order
+        ]
+    starts = np.array([k for k in range(len(keys)) if k == 0 or keys[k] != keys[k - 1]])
+    labels = tuple(keys[k] for k in starts)
+
+    order.setflags(write=False)
+    starts.setflags(write=False)
+    return labels, order, starts
+
+def calculate_partial_scores(dosages, level='chromosome', weights=None, block_cells=1 << 22):
+    """
+    一次分段归约（reduceat）计算每条染色体或每个位点的部分得分
+    dosages可为单人一维数组或(样本数, 变异数)矩阵，返回(段标签, 部分得分)
+    """
+    if weights is None:
+        weights = get_effect_weights()
+    labels, order, starts = get_score_segments(level)
+    dosages = np.asarray(dosages)
+    single = dosages.ndim == 1
+    dosages = np.atleast_2d(dosages)
+
+    ordered_weights = weights[order]
+    rows_per_block = max(1, block_cells // max(1, dosages.shape[1]))
+    partial = np.empty((dosages.shape[0], len(starts)))
+    for lo in range(0, dosages.shape[0], rows_per_block):
+        block = dosages[lo:lo + rows_per_block, order]
+        valid = (block >= 0) & (block <= 2)
+        contributions = np.where(valid, block, 0) * ordered_weights
+        partial[lo:lo + len(block)] = np.add.reduceat(contributions, starts, axis=1)
+
+    return labels, (partial[0] if single else partial)
+
+# ---------------------------------------------------------------------------
+# 多模型注册表：所有模型对齐到共享变异轴（SNP_IDS在前，其他模型新增的变异依次追加），
+# 权重保存为(变异数, 模型数)的稀疏矩阵，一次读取剂量、一次稀疏矩阵乘法得到N×K得分
+# ---------------------------------------------------------------------------
+
+DEFAULT_MODEL_ID = 'PGS000334'
+
+# 共享变异轴上SNP_DATA之外的变异：rsid -> {'effect_allele', 'other_allele', ...}
+EXTRA_VARIANTS = {}
+
+# 模型ID -> {'name', 'weights', 'offsets', 'effect_freqs'}，均按共享轴上的效应等位基因对齐
+PRS_MODELS = {}
+
+def get_model_variant_ids():
+    """返回共享变异轴：SNP_IDS之后依次是其他模型新增的变异"""
+    return SNP_IDS + tuple(EXTRA_VARIANTS)
+
+def _get_axis_variant(rsid):
+    return SNP_DATA[rsid] if rsid in SNP_DATA else EXTRA_VARIANTS[rsid]
+
+def register_prs_model(model_id, weights, name=None, effect_alleles=None, effect_freqs=None, variants=None):
+    """
+    注册评分模型：weights为{rsid: 效应权重}
+    effect_alleles为模型的效应等位基因（默认与共享轴一致），与轴相反时权重翻转为w·(2-d)；
+    effect_freqs为模型效应等位基因频率（SNP_DATA中的变异默认取其欧洲人群频率）；
+    variants提供共享轴上尚不存在的变异信息，至少包含effect_allele和other_allele
+    """
+    effect_alleles = effect_alleles or {}
+    effect_freqs = effect_freqs or {}
+    variants = variants or {}
+
+    new_variants = {}
+    for rsid in weights:
+        if rsid not in SNP_DATA and rsid not in EXTRA_VARIANTS:
+            if rsid not in variants:
+                raise ValueError(f"Model {model_id!r}: variant {rsid} is not on the shared axis and has no variant info")
+            new_variants[rsid] = dict(variants[rsid])
+
+    aligned = {'name': name or model_id, 'weights': {}, 'offsets': {}, 'effect_freqs': {}}
+    for rsid, weight in weights.items():
+        axis_variant = SNP_DATA.get(rsid) or EXTRA_VARIANTS.get(rsid) or new_variants[rsid]
+        effect_allele = effect_alleles.get(rsid, axis_variant['effect_allele'])
+        if rsid in effect_freqs:
+            freq = effect_freqs[rsid]
+        elif rsid in SNP_DATA:
+            freq = get_effect_allele_frequency(rsid, SNP_DATA[rsid])
+            if effect_allele != axis_variant['effect_allele']:
+                freq = 1 - freq
+        else:
+            freq = None
+
+        if effect_allele == axis_variant['effect_allele']:
+            aligned['weights'][rsid] = weight
+            aligned['effect_freqs'][rsid] = freq
+        elif effect_allele == axis_variant['other_allele']:
+            # w·(2-d) = 2w - w·d：权重取反，常数项2w只对有基因型的样本计入
+            aligned['weights'][rsid] = -weight
+            aligned['offsets'][rsid] = 2 * weight
+            aligned['effect_freqs'][rsid] = None if freq is None else 1 - freq
+        else:
+            raise ValueError(f"Model {model_id!r}: effect allele {effect_allele} does not match {rsid} "
+                             f"({axis_variant['effect_allele']}/{axis_variant['other_allele']})")
+
+    EXTRA_VARIANTS.update(new_variants)
+    PRS_MODELS[model_id] = aligned
+    get_model_weight_matrix.cache_clear()
+    get_model_info.cache_clear()
+    get_aligned_model_weights.cache_clear()
+    get_reference_pdf_grid.cache_clear()
+
+@lru_cache(maxsize=None)
+def get_model_info(model_id=DEFAULT_MODEL_ID):
+    """
+    返回模型的变异数、Hardy-Weinberg平衡下的人群均值/标准差和理论范围
+    缺少频率时均值和标准差为None；默认模型使用已发表的分布参数
+    """
+    model = PRS_MODELS[model_id]
+    weights = np.array(list(model['weights'].values()), dtype=np.float64)
+    offset = sum(model['offsets'].values())
+    info = {
+        'model_id': model_id,
+        'name': model['name'],
+        'n_variants': len(weights),
+        'min': float(offset + 2 * weights.clip(max=0).sum()),
+        'max': float(offset + 2 * weights.clip(min=0).sum()),
+        'mean': None,
+        'std': None
+    }
+    freqs = list(model['effect_freqs'].values())
+    if None not in freqs:
+        freqs = np.array(freqs, dtype=np.float64)
+        info['mean'] = float(offset + (2 * freqs * weights).sum())
+        info['std'] = float(np.sqrt((2 * freqs * (1 - freqs) * weights ** 2).sum()))
+    if model_id == DEFAULT_MODEL_ID:
+        info.update(mean=POPULATION_MEAN, std=POPULATION_STD, min=THEORETICAL_MIN, max=THEORETICAL_MAX)
+    return info
+
+# 参考正态曲线的网格点数
+REFERENCE_GRID_POINTS = 500
+
+@shared_asset(warm_args=lambda: [(model_id,) for model_id in PRS_MODELS])
+def get_reference_pdf_grid(model_id=DEFAULT_MODEL_ID):
+    """模型理论得分范围上的参考正态密度曲线，返回只读的(x, y)；分布未知的模型返回None"""
+    from scipy.stats import norm
+    info = get_model_info(model_id)
+    if info['std'] is None:
+        return None
+    x = np.linspace(info['min'], info['max'], REFERENCE_GRID_POINTS)
+    y = norm.pdf(x, loc=info['mean'], scale=info['std'])
+    for array in (x, y):
+        array.setflags(write=False)
+    return x, y
+
+@lru_cache(maxsize=None)
+def get_model_weight_matrix(model_ids=None):
+    """
+    构建共享变异轴上的稀疏权重矩阵(变异数, 模型数)和常数项矩阵（无翻转变异时为None）
+    结果按模型ID元组缓存，注册新模型时清空
+    """
+    from scipy.sparse import csc_array
+    model_ids = tuple(PRS_MODELS) if model_ids is None else model_ids
+    axis_index = {rsid: i for i, rsid in enumerate(get_model_variant_ids())}
+    shape = (len(axis_index), len(model_ids))
+
+    def to_sparse(field):
+        rows, cols, values = [], [], []
+        for k, model_id in enumerate(model_ids):
+            for rsid, value in PRS_MODELS[model_id][field].items():
+                rows.append(axis_index[rsid])
+                cols.append(k)
+                values.append(value)
+        return csc_array((np.array(values, dtype=np.float64), (rows, cols)), shape=shape)
+
+    weights = to_sparse('weights')
+    offsets = to_sparse('offsets')
+    return model_ids, weights, (offsets if offsets.nnz else None)
+
+def _score_dosage_matrix(matrix, weights, offsets, block_cells):
+    # 按行分块：每块只生成不超过block_cells个元素的临时数组，输入本身不被复制；
+    # weights为(变异数,)时返回一维得分，为(变异数, 模型数)时返回(样本数, 模型数)，缺失剂量不计分
+    rows_per_block = max(1, block_cells // max(1, matrix.shape[1]))
+    scores = np.empty((matrix.shape[0],) + weights.shape[1:])
+    for lo in range(0, matrix.shape[0], rows_per_block):
+        block = matrix[lo:lo + rows_per_block]
+        valid = (block >= 0) & (block <= 2)
+        block_scores = np.where(valid, block, 0).astype(np.float64) @ weights
+        if offsets is not None:
+            block_scores += valid.astype(np.float64) @ offsets
+        scores[lo:lo + len(block)] = block_scores
+    return scores
+
+def calculate_model_scores(dosages, model_ids=None, block_cells=1 << 22):
+    """
+    一次稀疏矩阵乘法同时计算K个模型的得分
+    dosages的列按共享变异轴排列（只含SNP_IDS时其余变异视为缺失），缺失剂量不计分
+    返回(模型ID元组, 得分)，得分形状为(样本数, 模型数)，一维输入返回长度为K的数组
+    """
+    model_ids, weights, offsets = get_model_weight_matrix(None if model_ids is None else tuple(model_ids))
+    dosages = np.asarray(dosages)
+    single = dosages.ndim == 1
+    dosages = np.atleast_2d(dosages)
+    n_columns = dosages.shape[1]
+    if n_columns > weights.shape[0]:
+        raise ValueError(f"Dosage matrix has {n_columns} columns but the shared variant axis has {weights.shape[0]}")
+    weights = weights[:n_columns]
+    offsets = None if offsets is None else offsets[:n_columns]
+
+    scores = _score_dosage_matrix(dosages, weights, offsets, block_cells)
+    return model_ids, (scores[0] if single else scores)
+
+def calculate_model_percentiles(scores, model_ids):
+    """按各模型的人群分布计算百分位（限制在0.1-99.9），分布未知的模型为NaN"""
+    from scipy.stats import norm
+    infos = [get_model_info(model_id) for model_id in model_ids]
+    means = np.array([np.nan if info['mean'] is None else info['mean'] for info in infos])
+    stds = np.array([np.nan if info['std'] is None else info['std'] for info in infos])
+    return np.clip(norm.cdf(scores, loc=means, scale=stds) * 100, 0.1, 99.9)
+
+@lru_cache(maxsize=256)
+def get_aligned_model_weights(variant_ids, model_id=DEFAULT_MODEL_ID):
+    """
+    按调用方给出的变异顺序排列模型的(权重, 常数项)只读数组，不在模型中的变异权重为0；
+    没有翻转变异时常数项为None。结果按(变异顺序元组, 模型ID)缓存，注册新模型时清空
+    """
+    model = PRS_MODELS[model_id]
+    weights = np.array([model['weights'].get(rsid, 0.0) for rsid in variant_ids], dtype=np.float64)
+    offsets = np.array([model['offsets'].get(rsid, 0.0) for rsid in variant_ids], dtype=np.float64)
+    weights.flags.writeable = False
+    offsets.flags.writeable = False
+    return weights, (offsets if offsets.any() else None)
+
+# 内置模型：完整PGS000334，以及拆分出的APOE与非APOE部分，便于并列比较
+APOE_SNP_IDS = tuple(rsid for rsid in SNP_IDS if SNP_DATA[rsid]['locus_name'] == 'APOE')
+
+register_prs_model(
+    DEFAULT_MODEL_ID,
+    {rsid: SNP_DATA[rsid]['effect_weight'] for rsid in SNP_IDS},
+    name=f"PGS000334 ({len(SNP_IDS)} SNPs)"
+)
+register_prs_model(
+    'PGS000334-noAPOE',
+    {rsid: SNP_DATA[rsid]['effect_weight'] for rsid in SNP_IDS if rsid not in APOE_SNP_IDS},
+    name=f"PGS000334 without APOE ({len(SNP_IDS) - len(APOE_SNP_IDS)} SNPs)"
+)
+register_prs_model(
+    'APOE',
+    {rsid: SNP_DATA[rsid]['effect_weight'] for rsid in APOE_SNP_IDS},
+    name=f"APOE only ({len(APOE_SNP_IDS)} SNPs)"
+)
+
+# 1000 Genomes欧洲人群（EUR）样本数，eur_freq_alt_allele基于此估计
+REFERENCE_SAMPLE_SIZE = 503
+
+# 权重四舍五入到0.01，真实值在±0.005内均匀分布时的标准差
+WEIGHT_ROUNDING_SE = 0.01 / np.sqrt(12)
+
+def get_effect_frequencies():
+    """按SNP_IDS顺序返回效应等位基因频率数组"""
+    return get_snp_model().columns['effect_freq']
+
+def get_effect_weight_ses():
+    """按SNP_IDS顺序返回效应权重的标准误，模型未提供时使用四舍五入误差"""
+    return np.array([SNP_DATA[rsid].get('effect_weight_se', WEIGHT_ROUNDING_SE) for rsid in SNP_IDS])
+
+def bootstrap_reference_distribution(n_boot=2000, sample_size=REFERENCE_SAMPLE_SIZE, rng=None):
+    """
+    重抽样效应等位基因频率和效应权重，一次向量化计算n_boot个参考分布的均值和标准差
+    频率按2*sample_size条染色体做二项抽样，权重按标准误做正态扰动
+    """
+    rng = np.random.default_rng(rng)
+    effect_freqs = get_effect_frequencies()
+    weights = get_effect_weights()
+    n_variants = len(SNP_IDS)
+
+    n_alleles = 2 * sample_size
+    freqs = rng.binomial(n_alleles, effect_freqs, size=(n_boot, n_variants)) / n_alleles
+    boot_weights = weights + rng.standard_normal((n_boot, n_variants)) * get_effect_weight_ses()
+
+    # Hardy-Weinberg下PRS的均值和方差
+    means = (2 * freqs * boot_weights).sum(axis=1)
+    stds = np.sqrt((2 * freqs * (1 - freqs) * boot_weights ** 2).sum(axis=1))
+    return means, stds
+
+def calculate_percentile_interval(prs_score, reference_means, reference_stds, level=0.95):
+    """根据参考分布的重抽样结果计算百分位的可信区间，返回(下限, 上限)"""
+    from scipy.stats import norm
+    percentiles = norm.cdf(prs_score, loc=reference_means, scale=reference_stds) * 100
+    percentiles = np.clip(percentiles, 0.1, 99.9)
+    tail = (1 - level) / 2 * 100
+    lower, upper = np.percentile(percentiles, [tail, 100 - tail])
+    return float(lower), float(upper)
+
+# ---------------------------------------------------------------------------
+# 缓冲区评分接口：供其他服务在进程内直接对已持有的NumPy数组、Arrow数组或任何支持缓冲区协议的对象
+# （memoryview、bytes、mmap等）评分，无需转换为{rsid: 基因型}字典，也不复制剂量数据。
+# variant_ids描述输入各列对应的变异；剂量为0/1/2，其他值（含-1、NaN、Arrow空值）视为缺失不计分。
+# 数值计算全部在NumPy的ufunc和BLAS内核中完成，这些内核运行时释放GIL，多个线程可同时评分
+# ---------------------------------------------------------------------------
+
+def _as_dosage_matrix(data, n_variants, variant_axis):
+    # ndarray直接使用；其他对象通过缓冲区协议取得零拷贝视图（保留其格式和形状）
+    matrix = data if isinstance(data, np.ndarray) else np.asarray(memoryview(data))
+    if matrix.dtype.kind not in 'iuf':
+        raise TypeError(f"Dosage buffer must hold integers or floats, got dtype {matrix.dtype}")
+    if matrix.ndim == 1:
+        # 一维缓冲区按变异数切分为样本行（reshape对连续内存只产生视图）
+        if n_variants == 0 or matrix.size % n_variants:
+            raise ValueError(f"Flat dosage buffer of length {matrix.size} is not a multiple of {n_variants} variants")
+        matrix = matrix.reshape(-1, n_variants) if variant_axis == 1 else matrix.reshape(n_variants, -1)
+    if matrix.ndim != 2:
+        raise ValueError(f"Expected a 1-D or 2-D dosage buffer, got {matrix.ndim} dimensions")
+    if variant_axis == 0:
+        matrix = matrix.T
+    if matrix.shape[1] != n_variants:
+        raise ValueError(f"Dosage buffer has {matrix.shape[1]} variants but the variant order lists {n_variants}")
+    return matrix
+
+def _score_arrow(data, variant_ids, model_id, variant_axis, block_cells):
+    import pyarrow as pa
+    if isinstance(data, pa.Table):
+        batches = data.to_batches()
+        if not batches:
+            return np.empty(0)
+        return np.concatenate([_score_arrow(batch, variant_ids, model_id, variant_axis, block_cells)
+                               for batch in batches])
+    if isinstance(data, pa.ChunkedArray):
+        if not data.num_chunks:
+            return np.empty(0)
+        return np.concatenate([_score_arrow(chunk, variant_ids, model_id, variant_axis, block_cells)
+                               for chunk in data.chunks])
+    if isinstance(data, pa.RecordBatch):
+        # 每列一个变异：逐列读取零拷贝视图并累加，未参与模型的列不会被读取
+        variant_ids = tuple(data.schema.names) if variant_ids is None else tuple(variant_ids)
+        if len(variant_ids) != data.num_columns:
+            raise ValueError(f"Record batch has {data.num_columns} columns but the variant order lists {len(variant_ids)}")
+        weights, offsets = get_aligned_model_weights(variant_ids, model_id)
+        scores = np.zeros(data.num_rows)
+        for j in np.flatnonzero(weights != 0):
+            column = data.column(int(j)).to_numpy(zero_copy_only=False)
+            valid = (column >= 0) & (column <= 2)
+            scores += np.where(valid, column, 0) * weights[j]
+            if offsets is not None:
+                scores += valid * offsets[j]
+        return scores
+    if isinstance(data, pa.Tensor):
+        return score_dosage_buffer(data.to_numpy(), variant_ids, model_id, variant_axis, block_cells)
+    if isinstance(data, pa.FixedSizeListArray):
+        if data.null_count:
+            raise ValueError("Null entries in a fixed-size-list dosage array are not supported")
+        width = data.type.list_size
+        values = data.values.slice(data.offset * width, len(data) * width)
+        matrix = values.to_numpy(zero_copy_only=False).reshape(-1, width)
+        return score_dosage_buffer(matrix, variant_ids, model_id, variant_axis, block_cells)
+    if isinstance(data, pa.Array):
+        # 无空值的数值数组为零拷贝视图；有空值时转换为以NaN表示缺失的浮点数组
+        return score_dosage_buffer(data.to_numpy(zero_copy_only=False), variant_ids, model_id,
+                                   variant_axis, block_cells)
+    # 其他实现Arrow C数据接口的对象（如polars、DuckDB的结果）先导入为pyarrow对象
+    if hasattr(data, '__arrow_c_stream__'):
+        return _score_arrow(pa.table(data), variant_ids, model_id, variant_axis, block_cells)
+    imported = pa.array(data)
+    if isinstance(imported, pa.StructArray):
+        imported = pa.RecordBatch.from_struct_array(imported)
+    return _score_arrow(imported, variant_ids, model_id, variant_axis, block_cells)
+
+def score_dosage_buffer(data, variant_ids=None, model_id=DEFAULT_MODEL_ID, variant_axis=1, block_cells=1 << 22):
+    """
+    对已在内存中的剂量数据评分，返回每个样本的得分（一维float64数组）
+
+    data可为NumPy数组、任何支持缓冲区协议的对象，或Arrow的Array/ChunkedArray/FixedSizeListArray/
+    Tensor/RecordBatch/Table（以及实现Arrow C数据接口的对象）；一维输入按变异数切分为样本。
+    variant_ids为输入各列（variant_axis=0时为各行）对应的rsid，默认按SNP_IDS排列，
+    RecordBatch/Table默认取列名；不在模型中的变异不计分，模型中未出现在输入里的变异视为缺失
+    """
+    if not isinstance(data, np.ndarray) and (
+        type(data).__module__.split('.')[0] == 'pyarrow'
+        or hasattr(data, '__arrow_c_array__') or hasattr(data, '__arrow_c_stream__')
+    ):
+        return _score_arrow(data, variant_ids, model_id, variant_axis, block_cells)
+    variant_ids = SNP_IDS if variant_ids is None else tuple(variant_ids)
+    weights, offsets = get_aligned_model_weights(variant_ids, model_id)
+    matrix = _as_dosage_matrix(data, len(variant_ids), variant_axis)
+    return _score_dosage_matrix(matrix, weights, offsets, block_cells)
+
+# ---------------------------------------------------------------------------
+# 可合并的流式汇总统计：每个评分块更新一次，不同进程或不同运行的结果可按map-reduce方式合并，
+# 内存占用与样本数无关；to_dict/from_dict用于在进程间或跨运行传递
+# ---------------------------------------------------------------------------
+
+class ScoreMoments:
+    """Welford/Chan算法累积的计数、均值、二阶中心矩和极值"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return self
+        chunk = ScoreMoments()
+        chunk.count = values.size
+        chunk.mean = float(values.mean())
+        chunk.m2 = float(((values - chunk.mean) ** 2).sum())
+        chunk.min = float(values.min())
+        chunk.max = float(values.max())
+        return self.merge(chunk)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2, 'min': self.min, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        moments = cls()
+        moments.count, moments.mean, moments.m2 = int(data['count']), data['mean'], data['m2']
+        moments.min, moments.max = data['min'], data['max']
+        return moments
+
+class ScoreHistogram:
+    """固定分箱直方图，另计落在范围外的下溢和上溢数；分箱相同的直方图可直接相加"""
+
+    def __init__(self, low=THEORETICAL_MIN, high=THEORETICAL_MAX, n_bins=200):
+        self.low = float(low)
+        self.high = float(high)
+        self.counts = np.zeros(n_bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    @property
+    def edges(self):
+        return np.linspace(self.low, self.high, len(self.counts) + 1)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        n_bins = len(self.counts)
+        bins = np.floor((values - self.low) / (self.high - self.low) * n_bins).astype(np.int64)
+        # 恰好等于上界的值计入最后一箱
+        bins[values == self.high] = n_bins - 1
+        self.underflow += int((bins < 0).sum())
+        self.overflow += int((bins >= n_bins).sum())
+        in_range = bins[(bins >= 0) & (bins < n_bins)]
+        self.counts += np.bincount(in_range, minlength=n_bins)
+        return self
+
+    def merge(self, other):
+        if (other.low, other.high, len(other.counts)) != (self.low, self.high, len(self.counts)):
+            raise ValueError("Cannot merge histograms with different bins")
+        self.counts += other.counts
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def to_dict(self):
+        return {'low': self.low, 'high': self.high, 'counts': self.counts.tolist(),
+                'underflow': self.underflow, 'overflow': self.overflow}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['low'], data['high'], len(data['counts']))
+        histogram.counts[:] = data['counts']
+        histogram.underflow, histogram.overflow = int(data['underflow']), int(data['overflow'])
+        return histogram
+
+class QuantileSketch:
+    """
+    KLL分位数草图：第h层的每个元素代表2^h个原始值，各层容量随层级向下按2/3递减；
+    层满时排序并随机保留奇数位或偶数位元素提升到上一层。总容量约3k，秩误差约为O(1/k)
+    """
+
+    def __init__(self, k=256, rng=None):
+        self.k = k
+        self.count = 0
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(rng)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def _compress(self):
+        while sum(map(len, self.levels)) > sum(self._capacity(h) for h in range(len(self.levels))):
+            for h, items in enumerate(self.levels):
+                if len(items) < self._capacity(h):
+                    continue
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                n_paired = len(items) - len(items) % 2
+                promoted = items[self.rng.integers(2):n_paired:2]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                self.levels[h] = items[n_paired:]
+                break
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.count += values.size
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, items in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """估计分位数，q可为标量或数组（0-1）"""
+        if self.count == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else float('nan')
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** h) for h, items in enumerate(self.levels)])
+        order = np.argsort(values, kind='stable')
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1], side='left')
+        result = values[order][np.minimum(positions, len(values) - 1)]
+        return float(result) if np.ndim(result) == 0 else result
+
+    def to_dict(self):
+        return {'k': self.k, 'count': self.count, 'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data, rng=None):
+        sketch = cls(data['k'], rng)
+        sketch.count = int(data['count'])
+        sketch.levels = [np.array(items, dtype=np.float64) for items in data['levels']]
+        return sketch
+
+class ScoreSummary:
+    """组合矩、直方图和分位数草图，描述一个队列的PRS分布"""
+
+    def __init__(self, low=THEORETICAL_MIN, high=THEORETICAL_MAX, n_bins=200, k=256, rng=None):
+        self.moments = ScoreMoments()
+        self.histogram = ScoreHistogram(low, high, n_bins)
+        self.sketch = QuantileSketch(k, rng)
+
+    def update(self, scores):
+        self.moments.update(scores)
+        self.histogram.update(scores)
+        self.sketch.update(scores)
+        return self
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+        return self
+
+    def describe(self, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        return {
+            'count': self.moments.count,
+            'mean': self.moments.mean,
+            'std': self.moments.std,
+            'min': self.moments.min,
+            'max': self.moments.max,
+            'quantiles': dict(zip(map(str, quantiles), np.atleast_1d(self.sketch.quantile(quantiles)).tolist()))
+        }
+
+    def to_dict(self):
+        return {'moments': self.moments.to_dict(), 'histogram': self.histogram.to_dict(),
+                'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, data, rng=None):
+        summary = cls.__new__(cls)
+        summary.moments = ScoreMoments.from_dict(data['moments'])
+        summary.histogram = ScoreHistogram.from_dict(data['histogram'])
+        summary.sketch = QuantileSketch.from_dict(data['sketch'], rng)
+        return summary
+
+class ScoreReservoir:
+    """
+    固定容量的均匀蓄水池样本（Algorithm R）：保留已评分记录中随机抽取的size条(样本ID, 得分)，
+    每块向量化更新；用于在全量评分结束前估计分位数
+    """
+
+    def __init__(self, size=10_000, rng=None):
+        self.size = size
+        self.count = 0
+        self.scores = np.empty(0)
+        self.sample_ids = np.empty(0, dtype=object)
+        self.rng = np.random.default_rng(rng)
+
+    def update(self, scores, sample_ids=None):
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        if sample_ids is None:
+            sample_ids = np.arange(self.count, self.count + scores.size)
+        sample_ids = np.asarray(sample_ids, dtype=object)
+
+        n_fill = min(self.size - len(self.scores), scores.size)
+        if n_fill > 0:
+            self.scores = np.concatenate([self.scores, scores[:n_fill]])
+            self.sample_ids = np.concatenate([self.sample_ids, sample_ids[:n_fill]])
+        self.count += n_fill
+
+        rest = scores.size - n_fill
+        if rest > 0:
+            # 第t条记录以size/t的概率替换随机位置；同一位置被多次选中时只保留最后一条，与逐条处理等价
+            slots = self.rng.integers(0, self.count + np.arange(1, rest + 1))
+            accepted = np.flatnonzero(slots < self.size)[::-1]
+            _, last = np.unique(slots[accepted], return_index=True)
+            accepted = accepted[last]
+            self.scores[slots[accepted]] = scores[n_fill + accepted]
+            self.sample_ids[slots[accepted]] = sample_ids[n_fill + accepted]
+            self.count += rest
+        return self
+
+    def merge(self, other):
+        """合并两个蓄水池：按两侧记录数的超几何分布决定各自保留多少条；两者容量须相同"""
+        if other.size != self.size:
+            # 容量不同时较小一侧保留的样本不足以按超几何分布抽取，合并结果不再是均匀样本
+            raise ValueError(f"Cannot merge reservoirs of different sizes ({self.size} and {other.size})")
+        total = self.count + other.count
+        n_keep = min(self.size, total)
+        if other.count == 0 or n_keep == 0:
+            return self
+        n_self = self.rng.hypergeometric(self.count, other.count, n_keep) if self.count else 0
+        keep_self = self.rng.choice(len(self.scores), n_self, replace=False)
+        keep_other = self.rng.choice(len(other.scores), n_keep - n_self, replace=False)
+        self.scores = np.concatenate([self.scores[keep_self], other.scores[keep_other]])
+        self.sample_ids = np.concatenate([self.sample_ids[keep_self], other.sample_ids[keep_other]])
+        self.count = total
+        return self
+
+    def quantile_bounds(self, q, population=None, level=0.95):
+        """
+        由样本顺序统计量估计分位数及其置信区间，返回(估计值, 下限, 上限)数组；
+        population为队列总数时应用有限总体校正，蓄水池覆盖全部记录时区间收缩为点估计
+        """
+        from scipy.stats import norm
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        n = len(self.scores)
+        if n == 0:
+            nan = np.full(q.shape, np.nan)
+            return nan, nan, nan
+        values = np.sort(self.scores)
+        fpc = np.sqrt(max(population - n, 0) / (population - 1)) if population and population > 1 else 1.0
+        half_width = norm.ppf(0.5 + level / 2) * np.sqrt(n * q * (1 - q)) * fpc
+        rank = q * (n - 1)
+        lower = values[np.clip(np.floor(rank - half_width), 0, n - 1).astype(np.int64)]
+        upper = values[np.clip(np.ceil(rank + half_width), 0, n - 1).astype(np.int64)]
+        return np.quantile(values, q), lower, upper
+
+# 队列密度曲线的网格点数，与百分位图上参考正态曲线的点数相同
+DENSITY_GRID_SIZE = 500
+
+def binned_kde(histogram, bandwidth=None):
+    """
+    分箱核密度估计：将直方图计数与离散化的高斯核卷积，返回(箱中心, 密度)；
+    输出长度只取决于分箱数，与样本数无关。bandwidth默认按Silverman规则由直方图估计
+    """
+    centers = (histogram.edges[:-1] + histogram.edges[1:]) / 2
+    bin_width = (histogram.high - histogram.low) / len(histogram.counts)
+    counts = histogram.counts.astype(np.float64)
+    n = counts.sum()
+    if n == 0:
+        return centers, np.zeros_like(centers)
+    if bandwidth is None:
+        mean = counts @ centers / n
+        std = np.sqrt(counts @ (centers - mean) ** 2 / max(n - 1, 1))
+        cumulative = np.cumsum(counts) / n
+        iqr = np.interp(0.75, cumulative, centers) - np.interp(0.25, cumulative, centers)
+        spread = min(std, iqr / 1.34) if iqr > 0 else std
+        bandwidth = max(0.9 * spread * n ** -0.2, bin_width)
+    sigma = bandwidth / bin_width
+    half_width = min(int(np.ceil(4 * sigma)), len(counts) - 1)
+    kernel = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / sigma) ** 2)
+    # 核可能比计数数组长（mode='same'会返回较长者的长度），因此完整卷积后取与箱对齐的中间部分
+    smoothed = np.convolve(counts, kernel / kernel.sum(), mode='full')[half_width:half_width + len(counts)]
+    return centers, smoothed / (n * bin_width)
+
+def describe_partial_distribution(histogram, reservoir, total=None, level=0.95,
+                                  quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), density_histogram=None):
+    """
+    由已评分记录的直方图和蓄水池样本生成分布快照（可JSON序列化）：
+    各箱密度及其置信区间、分位数估计及区间、经验百分位的DKW误差上限（百分点）；
+    给定细分箱的density_histogram时另附固定长度的核密度曲线。
+    误差只反映尚未评分的记录带来的抽样误差，前提是输入顺序与得分无关；total=已评分数时为精确结果
+    """
+    from scipy.stats import norm
+    n = int(histogram.counts.sum() + histogram.underflow + histogram.overflow)
+    final = total is not None and n >= total
+    fpc = np.sqrt(max(total - n, 0) / (total - 1)) if total and total > 1 else 1.0
+    edges = histogram.edges
+    width = np.diff(edges)
+    proportion = histogram.counts / max(n, 1)
+    half_width = norm.ppf(0.5 + level / 2) * np.sqrt(proportion * (1 - proportion) / max(n, 1)) * fpc
+    estimate, lower, upper = reservoir.quantile_bounds(quantiles, total, level)
+    snapshot = {
+        'final': bool(final),
+        'count': n,
+        'total': total,
+        'level': level,
+        'edges': edges.tolist(),
+        'density': (proportion / width).tolist(),
+        'density_lower': (np.maximum(proportion - half_width, 0) / width).tolist(),
+        'density_upper': ((proportion + half_width) / width).tolist(),
+        'quantiles': {str(q): [float(e), float(lo), float(hi)]
+                      for q, e, lo, hi in zip(quantiles, estimate, lower, upper)},
+        'percentile_error': float(np.sqrt(np.log(2 / (1 - level)) / (2 * max(n, 1))) * fpc * 100)
+    }
+    if density_histogram is not None:
+        kde_x, kde = binned_kde(density_histogram)
+        assert len(kde_x) == len(kde), f"KDE grid has {len(kde_x)} points but density has {len(kde)}"
+        snapshot['kde_x'] = kde_x.tolist()
+        snapshot['kde'] = kde.tolist()
+    return snapshot
+
+def main(argv=None):
+    """命令行流式评分：python -m prs_core [输入文件...]，从标准输入或文件读取，结果写到标准输出"""
+    import argparse
+    import sys
+    from cohort_scoring import OUTPUT_COLUMNS, stream_scores
+    from genotype_io import GENOME_BUILDS, INPUT_FORMATS
+
+    parser = argparse.ArgumentParser(
+        prog='python -m prs_core',
+        description="Stream genotype records (wide TSV, VCF or 23andMe/AncestryDNA text) and "
+                    "write PRS, percentile and risk tier per sample as TSV"
+    )
+    parser.add_argument('inputs', nargs='*', default=['-'],
+                        help="Input files ('-' or none for stdin); .gz is decompressed")
+    parser.add_argument('--format', choices=INPUT_FORMATS, default=None,
+                        help="Input format (default: detect from the first line)")
+    parser.add_argument('--chunk-size', type=int, default=10_000,
+                        help="Lines per chunk; bounds memory and output latency")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Worker processes for parsing and scoring")
+    parser.add_argument('--columns', default=','.join(OUTPUT_COLUMNS),
+                        help=f"Comma-separated output columns from: {', '.join(OUTPUT_COLUMNS)}")
+    parser.add_argument('--build', choices=sorted(GENOME_BUILDS), default='GRCh37',
+                        help="Genome build of VCF coordinates")
+    args = parser.parse_args(argv)
+
+    output_columns = tuple(column.strip() for column in args.columns.split(',') if column.strip())
+    unknown = [column for column in output_columns if column not in OUTPUT_COLUMNS]
+    if unknown or not output_columns:
+        parser.error(f"Unknown output columns: {', '.join(unknown) or '(none)'}")
+
+    try:
+        stream_scores(args.inputs, sys.stdout, args.format, args.chunk_size,
+                      args.workers, output_columns, args.build)
+    except BrokenPipeError:
+        # 下游（如head）提前关闭管道时静默退出
+        sys.stderr.close()
+
+if __name__ == "__main__":
+    main()
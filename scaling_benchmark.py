@@ -0,0 +1,299 @@
+import argparse
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+from prs_core import (
+    SNP_DATA,
+    SNP_IDS,
+    SparseDosages,
+    calculate_prs,
+    calculate_prs_batch,
+    calculate_prs_packed,
+    dosages_to_genotypes,
+    get_effect_frequencies,
+    get_effect_weights,
+    pack_dosages,
+    simulate_cohort_dosages
+)
+from genotype_io import (
+    build_coordinate_index,
+    read_consumer_dosages,
+    tsv_lines_to_dosages,
+    vcf_lines_to_model_dosages
+)
+from process_memory import get_rss_bytes
+
+# 规模基准：在不同样本数和模型变异数下运行各评分路径，记录吞吐量和峰值内存，
+# 并拟合耗时随样本数增长的幂指数，用于发现复杂度回归
+
+DEFAULT_SAMPLE_SIZES = [10**3, 10**4, 10**5, 10**6, 10**7]
+DEFAULT_VARIANT_COUNTS = [22, 10**3, 10**4, 10**5, 10**6]
+
+# 每条评分路径支持的最大样本数（纯Python路径和文本解析远慢于向量化路径）
+PATH_SAMPLE_LIMITS = {
+    'dict': 10**5,
+    'batch': None,
+    'packed': None,
+    'sparse': None,
+    'sparse_build': None,
+    'tsv_reader': 10**6,
+    'vcf_reader': 10**5,
+    'consumer_reader': 10**3
+}
+
+# 只适用于22个SNP的真实模型的路径
+MODEL_ONLY_PATHS = ('dict', 'tsv_reader', 'vcf_reader', 'consumer_reader')
+
+class RssSampler:
+    """后台线程定期采样RSS，记录运行期间相对基线的峰值增量"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.baseline = self.peak = get_rss_bytes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, get_rss_bytes())
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, get_rss_bytes())
+
+    @property
+    def peak_delta(self):
+        return self.peak - self.baseline
+
+# --rare时合成模型的效应等位基因频率范围（全基因组罕见变异模型中大多数剂量为0）
+RARE_FREQ_RANGE = (0.001, 0.05)
+
+def simulate_model(n_variants, rng, rare=False):
+    """从SNP_DATA的频率和权重中重抽样，生成任意规模的合成模型；rare时频率取自RARE_FREQ_RANGE"""
+    if n_variants == len(SNP_IDS) and not rare:
+        return get_effect_frequencies(), get_effect_weights()
+    if rare:
+        effect_freqs = rng.uniform(*RARE_FREQ_RANGE, size=n_variants)
+    else:
+        effect_freqs = rng.choice(get_effect_frequencies(), size=n_variants)
+    weights = rng.choice(get_effect_weights(), size=n_variants)
+    return effect_freqs, weights
+
+def _tsv_text(dosages):
+    header = 'IID\t' + '\t'.join(SNP_IDS) + '\n'
+    lines = [f"S{i}\t" + '\t'.join(map(str, row)) + '\n' for i, row in enumerate(dosages.tolist())]
+    return header, lines
+
+def _vcf_lines(dosages):
+    genotype_text = np.array(['0/0', '0/1', '1/1'])
+    lines = []
+    for j, rsid in enumerate(SNP_IDS):
+        snp_info = SNP_DATA[rsid]
+        # ALT设为效应等位基因，ALT剂量即效应剂量
+        lines.append(
+            f"{snp_info['chromosome']}\t{snp_info['position']}\t{rsid}\t{snp_info['other_allele']}\t"
+            f"{snp_info['effect_allele']}\t.\tPASS\t.\tGT\t" + '\t'.join(genotype_text[dosages[:, j]]) + '\n'
+        )
+    return lines
+
+def _consumer_lines(dosages_row, filler_lines=10_000):
+    lines = ['# rsid\tchromosome\tposition\tgenotype\n']
+    lines += [f"rs{100_000_000 + k}\t1\t{k}\tAG\n" for k in range(filler_lines)]
+    for rsid, genotype in dosages_to_genotypes(dosages_row).items():
+        snp_info = SNP_DATA[rsid]
+        lines.append(f"{rsid}\t{snp_info['chromosome']}\t{snp_info['position']}\t{genotype}\n")
+    return lines
+
+def prepare_path(path, dosages, weights):
+    """准备评分路径的输入（不计时），返回待计时的无参函数"""
+    if path == 'dict':
+        genotypes = [dosages_to_genotypes(row) for row in dosages]
+        return lambda: [calculate_prs(g) for g in genotypes]
+    if path == 'batch':
+        return lambda: calculate_prs_batch(dosages, weights)
+    if path == 'packed':
+        packed = pack_dosages(dosages)
+        return lambda: calculate_prs_packed(packed, weights)
+    if path == 'sparse':
+        # 只计评分；从稠密矩阵构建CSR的开销由sparse_build单独计时
+        sparse = SparseDosages.from_dense(dosages)
+        return lambda: sparse.score(weights)
+    if path == 'sparse_build':
+        return lambda: SparseDosages.from_dense(dosages)
+    if path == 'tsv_reader':
+        header, lines = _tsv_text(dosages)
+        names = header.rstrip('\n').split('\t')
+        return lambda: calculate_prs_batch(tsv_lines_to_dosages(names, lines)[1])
+    if path == 'vcf_reader':
+        lines = _vcf_lines(dosages)
+        index = build_coordinate_index()
+        return lambda: vcf_lines_to_model_dosages(lines, index)
+    if path == 'consumer_reader':
+        # 每个样本一份原始数据文件；各文件内容结构相同，只生成一份并重复解析
+        lines = _consumer_lines(dosages[0])
+        return lambda: [read_consumer_dosages(lines) for _ in range(len(dosages))]
+    raise ValueError(f"Unknown scoring path: {path}")
+
+def measure(run):
+    """计时运行一次（RSS采样），再在tracemalloc下运行一次获取Python/NumPy分配峰值"""
+    with RssSampler() as sampler:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        run()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return elapsed, traced_peak, sampler.peak_delta
+
+def run_benchmark(paths, sample_sizes, variant_counts, max_cells=10**9, seed=0, rare=False, log=print):
+    """运行所有路径 × 样本数 × 变异数组合，返回结果记录列表"""
+    rng = np.random.default_rng(seed)
+    records = []
+    for n_variants in variant_counts:
+        effect_freqs, weights = simulate_model(n_variants, rng, rare)
+        for n_samples in sample_sizes:
+            if n_samples * n_variants > max_cells:
+                continue
+            active = [
+                path for path in paths
+                if (PATH_SAMPLE_LIMITS[path] is None or n_samples <= PATH_SAMPLE_LIMITS[path])
+                and (path not in MODEL_ONLY_PATHS or n_variants == len(SNP_IDS))
+            ]
+            if not active:
+                continue
+            dosages = simulate_cohort_dosages(n_samples, rng, effect_freqs)
+            for path in active:
+                run = prepare_path(path, dosages, weights)
+                elapsed, traced_peak, rss_peak = measure(run)
+                record = {
+                    'path': path,
+                    'n_samples': n_samples,
+                    'n_variants': n_variants,
+                    'seconds': elapsed,
+                    'samples_per_second': n_samples / elapsed,
+                    'genotypes_per_second': n_samples * n_variants / elapsed,
+                    'peak_traced_bytes': traced_peak,
+                    'peak_rss_delta_bytes': rss_peak
+                }
+                records.append(record)
+                log(f"{path:>16} N={n_samples:>9,} M={n_variants:>9,}  {elapsed:9.4f} s  "
+                    f"{record['samples_per_second']:>14,.0f} samples/s  "
+                    f"peak {traced_peak / 2**20:8.1f} MB traced / {rss_peak / 2**20:8.1f} MB RSS")
+                del run
+            del dosages
+    return records
+
+def fit_scaling_exponents(records):
+    """对每条路径和变异数，拟合log(耗时) ~ k·log(样本数)的斜率k（线性算法应接近1）"""
+    exponents = {}
+    groups = {}
+    for record in records:
+        groups.setdefault((record['path'], record['n_variants']), []).append(record)
+    for (path, n_variants), group in groups.items():
+        # 过小的规模主要测到固定开销，只用样本数>=10^4的点拟合
+        points = [(r['n_samples'], r['seconds']) for r in group if r['n_samples'] >= 10**4]
+        if len(points) < 2:
+            continue
+        x, y = np.log10(np.array(points, dtype=np.float64)).T
+        exponents[f"{path}/M={n_variants}"] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+def plot_scaling_curves(records, output_dir):
+    """绘制耗时和峰值内存随样本数变化的曲线（对数坐标）"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax_time, ax_memory) = plt.subplots(1, 2, figsize=(13, 5))
+    groups = {}
+    for record in records:
+        groups.setdefault((record['path'], record['n_variants']), []).append(record)
+    for (path, n_variants), group in sorted(groups.items()):
+        group.sort(key=lambda r: r['n_samples'])
+        n = [r['n_samples'] for r in group]
+        label = f"{path} (M={n_variants:,})"
+        ax_time.plot(n, [r['seconds'] for r in group], marker='o', label=label)
+        ax_memory.plot(n, [r['peak_traced_bytes'] / 2**20 for r in group], marker='o', label=label)
+
+    for ax, ylabel in ((ax_time, 'Seconds'), (ax_memory, 'Peak traced memory (MB)')):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('Samples')
+        ax.set_ylabel(ylabel)
+        ax.grid(True, which='both', alpha=0.3)
+    ax_memory.legend(fontsize=7, loc='upper left')
+    fig.tight_layout()
+
+    path = os.path.join(output_dir, 'scaling_curves.png')
+    fig.savefig(path, dpi=120)
+    plt.close(fig)
+    return path
+
+def compare_exponents(exponents, baseline_path, tolerance=0.2):
+    """与基线结果比较幂指数，返回超出容差的回归项"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)['scaling_exponents']
+    return {
+        key: (baseline[key], value)
+        for key, value in exponents.items()
+        if key in baseline and value > baseline[key] + tolerance
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Cohort-scale throughput and memory scaling benchmark")
+    parser.add_argument('--paths', nargs='+', default=list(PATH_SAMPLE_LIMITS),
+                        choices=list(PATH_SAMPLE_LIMITS))
+    parser.add_argument('--samples', type=int, nargs='+', default=DEFAULT_SAMPLE_SIZES)
+    parser.add_argument('--variants', type=int, nargs='+', default=DEFAULT_VARIANT_COUNTS)
+    parser.add_argument('--max-cells', type=float, default=1e9,
+                        help="Skip sample x variant combinations larger than this (int8 dosages)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rare', action='store_true',
+                        help=f"Simulate rare-variant models (effect allele frequency {RARE_FREQ_RANGE[0]}-{RARE_FREQ_RANGE[1]})")
+    parser.add_argument('--output-dir', default='bench_results')
+    parser.add_argument('--no-plot', action='store_true')
+    parser.add_argument('--baseline', help="Previous scaling.json; exit non-zero if any exponent regressed")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    records = run_benchmark(args.paths, sorted(args.samples), sorted(args.variants),
+                            int(args.max_cells), args.seed, args.rare)
+    exponents = fit_scaling_exponents(records)
+
+    result_path = os.path.join(args.output_dir, 'scaling.json')
+    with open(result_path, 'w') as f:
+        json.dump({'records': records, 'scaling_exponents': exponents}, f, indent=2)
+    print(f"\nResults written to {result_path}")
+    for key, value in sorted(exponents.items()):
+        print(f"  {key:>32}: time ~ N^{value:.2f}")
+
+    if not args.no_plot and records:
+        print(f"Plot written to {plot_scaling_curves(records, args.output_dir)}")
+
+    if args.baseline:
+        regressions = compare_exponents(exponents, args.baseline)
+        for key, (before, after) in regressions.items():
+            print(f"REGRESSION {key}: N^{before:.2f} -> N^{after:.2f}")
+        if regressions:
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()